@@ -6,11 +6,22 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    # Imported inside functions since startup went lazy, listed so the
+    # bundle keeps them whatever the analysis finds
+    hiddenimports=[
+        'PIL.Image',
+        'PIL.ImageDraw',
+        'PIL.ImageFont',
+        'exifread',
+        'openpyxl',
+        'asyncio',
+        'concurrent.futures.process',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    # Pulled in by Pillow's hooks, never used by the command line app
+    excludes=['tkinter'],
     noarchive=False,
     optimize=0,
 )
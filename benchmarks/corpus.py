@@ -0,0 +1,137 @@
+"""Synthetic image corpora for the benchmarks.
+
+The same profile and seed always give the same files, so runs on different
+commits can be compared:
+
+    python benchmarks/corpus.py /tmp/corpus --profile standard --heic
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+
+from PIL import ExifTags, Image, ImageDraw
+
+PROFILES = {
+    # megapixels of the images, number of images, directory depth
+    "quick": {"megapixels": (1, 2), "images": 24, "depth": 2},
+    "standard": {"megapixels": (1, 4, 12, 24), "images": 48, "depth": 3},
+    "large": {"megapixels": (1, 12, 24, 50), "images": 40, "depth": 3},
+}
+
+# Cycled through so every corpus has a mix of files with full, partial and no
+# metadata
+KINDS = ("jpeg-exif-gps", "jpeg-exif", "jpeg-plain", "png")
+ORIENTATIONS = (1, 6, 3, 8)
+
+
+def image_size(megapixels, landscape=True):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    return (width, height) if landscape else (height, width)
+
+
+def make_exif(rng, orientation, gps=True):
+    exif = Image.Exif()
+    exif[ExifTags.Base.Make] = "Canon"
+    exif[ExifTags.Base.Model] = "EOS 5D"
+    exif[ExifTags.Base.Orientation] = orientation
+
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+    day = rng.randint(1, 28)
+    exif_ifd[ExifTags.Base.DateTimeOriginal] = f"2024:05:{day:02d} 10:11:12"
+    exif_ifd[ExifTags.Base.OffsetTime] = "-05:00"
+
+    if gps:
+        gps_ifd = exif.get_ifd(ExifTags.IFD.GPSInfo)
+        gps_ifd[ExifTags.GPS.GPSLatitudeRef] = "N"
+        gps_ifd[ExifTags.GPS.GPSLatitude] = (39.0, float(rng.randint(0, 59)), 30.5)
+        gps_ifd[ExifTags.GPS.GPSLongitudeRef] = "W"
+        gps_ifd[ExifTags.GPS.GPSLongitude] = (94.0, float(rng.randint(0, 59)), 44.2)
+    return exif
+
+
+def make_pixels(rng, size):
+    # A gradient with a few blocks of color, cheap to make at 50 MP but not
+    # trivial for the encoders
+    img = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for _ in range(8):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + size[0] // 6, y + size[1] // 6), fill=color)
+    return img
+
+
+def make_corpus(directory, profile="quick", heic=False, seed=0):
+    # Writes the images to directory/IMAGES_IN and returns a manifest
+    settings = PROFILES[profile]
+    rng = random.Random(seed)
+    input_directory = os.path.join(directory, "IMAGES_IN")
+    shutil.rmtree(input_directory, ignore_errors=True)
+
+    kinds = KINDS + ("heic",) if heic else KINDS
+    if heic:
+        import pillow_heif
+
+        pillow_heif.register_heif_opener()
+
+    manifest = {"profile": profile, "seed": seed, "images": 0, "bytes": 0, "kinds": {}}
+    for index in range(settings["images"]):
+        kind = kinds[index % len(kinds)]
+        megapixels = settings["megapixels"][index % len(settings["megapixels"])]
+        orientation = ORIENTATIONS[index % len(ORIENTATIONS)]
+
+        # Spread the files over nested directories, some at the top level
+        parts = [
+            f"dir_{(index // 3 ** level) % 3}"
+            for level in range(index % (settings["depth"] + 1))
+        ]
+        folder = os.path.join(input_directory, *parts)
+        os.makedirs(folder, exist_ok=True)
+
+        # Stored sideways when the EXIF says the camera was turned
+        landscape = orientation in (1, 3) or kind in ("jpeg-plain", "png")
+        img = make_pixels(rng, image_size(megapixels, landscape))
+        name = f"IMG_{index:04d}_{megapixels}mp"
+        if kind == "png":
+            path = os.path.join(folder, name + ".png")
+            img.save(path, compress_level=1)
+        elif kind == "heic":
+            path = os.path.join(folder, name + ".heic")
+            img.save(path, quality=80, exif=make_exif(rng, 1).tobytes())
+        elif kind == "jpeg-plain":
+            path = os.path.join(folder, name + ".jpg")
+            img.save(path, quality=90)
+        else:
+            path = os.path.join(folder, name + ".jpg")
+            exif = make_exif(rng, orientation, gps=kind == "jpeg-exif-gps")
+            img.save(path, quality=90, exif=exif.tobytes())
+
+        manifest["images"] += 1
+        manifest["bytes"] += os.path.getsize(path)
+        manifest["kinds"][kind] = manifest["kinds"].get(kind, 0) + 1
+
+    with open(os.path.join(directory, "corpus.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--profile", choices=tuple(PROFILES), default="quick")
+    parser.add_argument("--heic", action="store_true", help="include HEIC files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    json.dump(
+        make_corpus(args.directory, args.profile, args.heic, args.seed), sys.stdout
+    )
+    print()
+
+
+if __name__ == "__main__":
+    main()
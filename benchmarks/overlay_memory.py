@@ -0,0 +1,183 @@
+"""Peak memory of stamping one image, old full-frame overlay vs label tile.
+
+Each measurement runs in a fresh Python process so the peak RSS belongs to
+that one render:
+
+    python benchmarks/overlay_memory.py --megapixels 12 48
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_metadata_extractor as extractor  # noqa: E402
+
+LABEL_TEXT = (
+    "Filename: IMG_0001.jpg\n"
+    "Latitude: 39° 5' 30.50\" N\n"
+    "Longitude: 94° 34' 44.20\" W\n"
+    "Date/Time: 2024-05-01 10:11:12\n"
+    "Make: Canon\n"
+    "Model: EOS 5D\n"
+)
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def legacy_render_overlay(
+    image_path,
+    text,
+    position,
+    overlay_position="top-left",
+    color=(0, 0, 0),
+    background_color=(255, 255, 255, 128),
+):
+    # The renderer before the label tile change: a full-frame RGBA copy of the
+    # photo plus a second full-frame RGBA canvas for the box and text
+    img = extractor.open_image_without_orientation(image_path).convert("RGBA")
+    overlay = Image.new("RGBA", img.size, (255, 255, 255, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+
+    width, height = img.size
+    font = extractor.load_font(extractor.FONT_PATH, max(12, int(height * 0.02)))
+    padding_left = int(min(width, height) * extractor.PADDING_LEFT_FACTOR)
+    padding_right = int(padding_left * extractor.PADDING_RIGHT_FACTOR)
+    padding_top = int(height * extractor.PADDING_TOP_FACTOR)
+    padding_bottom = int(height * extractor.PADDING_BOTTOM_FACTOR)
+
+    text = extractor.METADATA_HEADER + text
+    text_width, text_height = overlay_draw.textbbox((0, 0), text, font=font)[2:]
+
+    if overlay_position == "top-left":
+        text_position = (position[0], position[1])
+    elif overlay_position == "top-right":
+        text_position = (width - text_width - padding_right, position[1])
+    elif overlay_position == "bottom-left":
+        text_position = (position[0], height - text_height - padding_bottom)
+    else:
+        text_position = (
+            width - text_width - padding_right,
+            height - text_height - padding_bottom,
+        )
+
+    box = (
+        text_position[0] - padding_left,
+        text_position[1] - padding_top,
+        text_position[0] + text_width + padding_right,
+        text_position[1] + text_height + padding_bottom,
+    )
+    overlay_draw.rectangle((box[:2], box[2:]), fill=background_color)
+    overlay_draw.text(text_position, text, fill=color, font=font)
+    cropped_overlay = overlay.crop(box)
+    img.paste(cropped_overlay, box[:2], mask=cropped_overlay)
+    return img
+
+
+def label_tile_render_overlay(
+    image_path,
+    text,
+    position,
+    overlay_position="top-left",
+):
+    # What render_image() does before encoding: the label is drawn on a tile
+    # and blended onto the region under it
+    img = extractor.open_image_without_orientation(image_path)
+    return extractor.draw_overlay(img, text, position, overlay_position)
+
+
+RENDERERS = {
+    "full-frame": legacy_render_overlay,
+    "label-tile": label_tile_render_overlay,
+}
+
+
+def measure(renderer, image_path):
+    # Child process: decode and stamp one image, report memory in bytes
+    Image.open(image_path).close()
+    baseline = peak_rss_bytes()
+    img = RENDERERS[renderer](image_path, LABEL_TEXT, (10, 10), "bottom-right")
+    img.load()
+    peak = peak_rss_bytes()
+    return {"baseline_rss": baseline, "peak_rss": peak, "render_rss": peak - baseline}
+
+
+def make_image(directory, megapixels):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    path = os.path.join(directory, f"synthetic_{megapixels}mp.jpg")
+    # A gradient so the JPEG encoder has something to do
+    Image.linear_gradient("L").resize((width, height)).convert("RGB").save(
+        path, quality=90
+    )
+    return path
+
+
+def run_child(*args):
+    # Linux carries the peak RSS of a process across fork and exec, so the
+    # parent never holds a decoded image itself
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(megapixels):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in megapixels:
+            image_path = run_child("make", directory, str(size))
+            for renderer in RENDERERS:
+                result = run_child(renderer, image_path)
+                result.update(renderer=renderer, megapixels=size)
+                results.append(result)
+                print(
+                    f"{size:>4} MP  {renderer:<10}  peak {result['peak_rss'] / 2**20:8.1f} MB"
+                    f"  render {result['render_rss'] / 2**20:8.1f} MB",
+                    file=sys.stderr,
+                )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megapixels", type=int, nargs="+", default=[12, 48])
+    parser.add_argument("--json", help="Also write the results to this file.")
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.child[0] == "make":
+            print(json.dumps(make_image(args.child[1], int(args.child[2]))))
+        else:
+            print(json.dumps(measure(*args.child)))
+        return
+
+    results = run(args.megapixels)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""End-to-end benchmarks of process_directory() on a synthetic corpus.
+
+Each mode runs in a fresh Python process on its own copy of the corpus and
+reports throughput, per-stage latency and peak memory. Results are written as
+JSON and can be compared against an earlier run:
+
+    python benchmarks/run_benchmarks.py --profile quick --json after.json
+    python benchmarks/run_benchmarks.py --compare before.json --json after.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_metadata_extractor as extractor  # noqa: E402
+from corpus import PROFILES, make_corpus  # noqa: E402
+from overlay_memory import peak_rss_bytes  # noqa: E402
+
+MODES = {
+    "serial": {"workers": 1, "use_cache": False, "metadata_backend": "in-process"},
+    "parallel": {
+        "workers": max(2, os.cpu_count() or 1),
+        "use_cache": False,
+        "metadata_backend": "in-process",
+    },
+    # Large images wait for each other instead of all being decoded at once
+    "parallel-budget": {
+        "workers": max(2, os.cpu_count() or 1),
+        "use_cache": False,
+        "metadata_backend": "in-process",
+        "memory_budget": 256,
+    },
+    "pipeline": {
+        "workers": 1,
+        "use_cache": False,
+        "metadata_backend": "in-process",
+        "pipeline": True,
+    },
+    "pipeline-parallel": {
+        "workers": max(2, os.cpu_count() or 1),
+        "use_cache": False,
+        "metadata_backend": "in-process",
+        "pipeline": True,
+    },
+    # Run once to fill the cache, then measure a second run of the same files
+    "cached": {"workers": 1, "use_cache": True, "metadata_backend": "in-process"},
+    "exiftool": {"workers": 1, "use_cache": False, "metadata_backend": "exiftool"},
+    # Every fourth image is copied under the same name into another folder,
+    # so the copies land on the output path of the first one
+    "duplicates-link": {
+        "workers": 1,
+        "use_cache": False,
+        "metadata_backend": "in-process",
+        "duplicate_action": "link",
+    },
+}
+
+
+def peak_worker_rss_bytes():
+    try:
+        import resource
+    except ImportError:  # Windows, worker memory is not available
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_once(corpus_directory, work_directory, settings, output_format):
+    input_directory = os.path.join(work_directory, "IMAGES_IN")
+    shutil.rmtree(work_directory, ignore_errors=True)
+    shutil.copytree(os.path.join(corpus_directory, "IMAGES_IN"), input_directory)
+    if settings.get("duplicate_action"):
+        copies_directory = os.path.join(input_directory, "copies")
+        os.makedirs(copies_directory)
+        images = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(input_directory)
+            for name in names
+        )
+        for path in images[::4]:
+            shutil.copy(path, copies_directory)
+    return extractor.process_directory(
+        input_directory,
+        os.path.join(work_directory, "IMAGES_OUT"),
+        os.path.join(work_directory, "IMAGES_ERROR"),
+        metadata_format="csv",
+        resume=False,
+        output_format=output_format,
+        cache_path=os.path.join(work_directory, "..", "metadata_cache.sqlite"),
+        **settings,
+    )
+
+
+def measure(mode, corpus_directory, work_directory, output_format):
+    # Child process: run one mode and report its statistics
+    logging.basicConfig(level=logging.WARNING)
+    settings = MODES[mode]
+    if mode == "cached":
+        run_once(corpus_directory, work_directory, settings, output_format)
+
+    result = run_once(corpus_directory, work_directory, settings, output_format)
+    summary = result.to_dict()
+    summary["failed"] = len(result.failed)
+    # Anything left under the partial suffix is an output that never got
+    # its final name
+    summary["partial_files"] = sum(
+        name.endswith(extractor.PARTIAL_SUFFIX)
+        for _, _, names in os.walk(os.path.join(work_directory, "IMAGES_OUT"))
+        for name in names
+    )
+    summary.update(
+        mode=mode,
+        settings=settings,
+        peak_rss=peak_rss_bytes(),
+        peak_worker_rss=peak_worker_rss_bytes(),
+    )
+    return summary
+
+
+def run_child(*args):
+    # A fresh process per mode keeps the peak memory of one mode from showing
+    # up in the next
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(modes, profile, heic, output_format, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        corpus_directory = os.path.join(directory, "corpus")
+        corpus = run_child("corpus", corpus_directory, profile, str(int(heic)))
+
+        for mode in modes:
+            if mode == "exiftool" and not extractor.exiftool_available():
+                print("Skipping exiftool: ExifTool was not found", file=sys.stderr)
+                continue
+            for attempt in range(repeat):
+                work_directory = os.path.join(directory, mode, "run")
+                result = run_child(
+                    mode, corpus_directory, work_directory, output_format
+                )
+                result["attempt"] = attempt
+                results.append(result)
+                print(
+                    f"{mode:<17} {result['processed']:>4} images  "
+                    f"{result['images_per_second']:7.2f} images/s  "
+                    f"peak {result['peak_rss'] / 2**20:7.1f} MB",
+                    file=sys.stderr,
+                )
+                if result["partial_files"]:
+                    print(
+                        f"{mode:<17} left {result['partial_files']} partial files "
+                        "in the output directory",
+                        file=sys.stderr,
+                    )
+                shutil.rmtree(os.path.join(directory, mode), ignore_errors=True)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "version": extractor.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "profile": profile,
+        "output_format": output_format,
+        "corpus": corpus,
+        "results": results,
+    }
+
+
+def best_throughput(report):
+    best = {}
+    for result in report["results"]:
+        best[result["mode"]] = max(
+            best.get(result["mode"], 0.0), result["images_per_second"]
+        )
+    return best
+
+
+def compare(baseline, report):
+    before = best_throughput(baseline)
+    for mode, after in best_throughput(report).items():
+        if before.get(mode):
+            change = (after / before[mode] - 1) * 100
+            print(
+                f"{mode:<17} {before[mode]:7.2f} -> {after:7.2f} images/s ({change:+.1f}%)"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", choices=tuple(PROFILES), default="quick")
+    parser.add_argument("--modes", nargs="+", choices=tuple(MODES), default=list(MODES))
+    parser.add_argument("--heic", action="store_true", help="include HEIC files")
+    parser.add_argument(
+        "--output-format", default="png", help="format of the stamped images"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="runs per mode")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run to compare to")
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.child[0] == "corpus":
+            directory, profile, heic = args.child[1:]
+            print(json.dumps(make_corpus(directory, profile, heic == "1")))
+        else:
+            print(json.dumps(measure(*args.child)))
+        return
+
+    report = run(args.modes, args.profile, args.heic, args.output_format, args.repeat)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+    if any(result["partial_files"] for result in report["results"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Startup time of the extractor: import, --version, --check and --help.
+
+Each command runs in a fresh Python process and the fastest of several runs
+is reported, next to the time Python itself needs to start:
+
+    python benchmarks/startup.py --repeat 20 --json startup.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "image_metadata_extractor.py")
+
+COMMANDS = {
+    "python": ["-c", "pass"],
+    "import": ["-c", "import image_metadata_extractor"],
+    "--version": [SCRIPT, "--version"],
+    "--check": [SCRIPT, "--check"],
+    "--help": [SCRIPT, "--help"],
+}
+
+# Should only be loaded once a feature needs them
+HEAVY_MODULES = (
+    "PIL.Image",
+    "PIL.ImageFont",
+    "pillow_heif",
+    "exifread",
+    "openpyxl",
+    "numpy",
+    "asyncio",
+    "concurrent.futures.process",
+)
+
+
+def time_command(arguments, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *arguments], cwd=ROOT, check=True, capture_output=True
+        )
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {"min": times[0], "median": times[len(times) // 2]}
+
+
+def loaded_heavy_modules():
+    # Imports the module in a fresh process and lists what came with it
+    code = (
+        "import json, sys\n"
+        "import image_metadata_extractor\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True
+    ).stdout
+    return json.loads(output)
+
+
+def import_times(limit=10):
+    # The slowest imports by cumulative time, from python -X importtime
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import image_metadata_extractor"],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    times = []
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        times.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(times, reverse=True)[:limit]
+
+
+def run(repeat):
+    results = {
+        name: time_command(arguments, repeat) for name, arguments in COMMANDS.items()
+    }
+    for name, result in results.items():
+        print(
+            f"{name:<10} min {result['min'] * 1000:7.1f} ms  "
+            f"median {result['median'] * 1000:7.1f} ms",
+            file=sys.stderr,
+        )
+
+    heavy = loaded_heavy_modules()
+    print(
+        f"heavy modules loaded on import: {', '.join(heavy) or 'none'}", file=sys.stderr
+    )
+    slowest = import_times()
+    for seconds, name in slowest:
+        print(f"  {seconds * 1000:7.1f} ms  {name}", file=sys.stderr)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "repeat": repeat,
+        "commands": results,
+        "heavy_modules_loaded": heavy,
+        "slowest_imports": [{"module": name, "seconds": s} for s, name in slowest],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10, help="runs per command")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    report = run(max(1, args.repeat))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,64 @@
 # MetadataExtractor/image_metadata_extractor.py
 
+import argparse
+import contextlib
+import csv
+import fnmatch
+import functools
+import glob
+import hashlib
+import io
+import itertools
 import json
 import logging
-import openpyxl
 import os
-import pillow_heif
+import queue
+import random
 import re
 import shutil
+import signal
+import socket
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 from datetime import datetime
-from exifread import process_file
 from fractions import Fraction as Ratio
-from PIL import Image, ImageDraw, ImageFont, ExifTags
+
+# Pillow, pillow_heif, exifread, openpyxl, asyncio and the executors are
+# imported where they are first needed, so --version, --check and --help
+# start without loading them
 
 # Increase the pixel limit to 300 million pixels
-Image.MAX_IMAGE_PIXELS = 300000000
+MAX_IMAGE_PIXELS = 300000000
 
 # Versioning
 __version__ = "2.3.0"
 # pyinstaller --onefile --icon=metadata.ico --name MetaData-V2.3.0 image_metadata_extractor.py
 # pyinstaller --onefile --icon=metadata.ico --name MetaData-V2.3.0 --add-data "exiftool-13.09_64/exiftool.exe;exiftool-13.09_64" --add-data "exiftool-13.09_64/exiftool_files;exiftool-13.09_64/exiftool_files" --paths "exiftool-13.09_64/exiftool_files" image_metadata_extractor.py
+# For scripts that start it often, --onedir instead of --onefile saves unpacking the whole build on every launch, and tkinter is never used:
+# pyinstaller --onedir --exclude-module tkinter --icon=metadata.ico --name MetaData-V2.3.0 --add-data "exiftool-13.09_64/exiftool.exe;exiftool-13.09_64" --add-data "exiftool-13.09_64/exiftool_files;exiftool-13.09_64/exiftool_files" --paths "exiftool-13.09_64/exiftool_files" image_metadata_extractor.py
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 
 
-def setup_logging():
-    log_file = "metadata_extraction.log"
+LOG_FILE = "metadata_extraction.log"
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def setup_logging(assume_yes=False):
+    log_file = LOG_FILE
 
     if os.path.exists(log_file):
-        response = input(
-            f"Log file '{log_file}' already exists. Delete it? (y/n, default y): "
+        response = (
+            "y"
+            if assume_yes
+            else input(
+                f"Log file '{log_file}' already exists. Delete it? (y/n, default y): "
+            )
         )
         if response.lower() != "n":
             os.remove(log_file)
@@ -41,8 +68,8 @@ def setup_logging():
 
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
+        format=LOG_FORMAT,
+        datefmt=LOG_DATE_FORMAT,
         handlers=[
             logging.FileHandler(log_file),
             logging.StreamHandler(),
@@ -50,15 +77,173 @@ def setup_logging():
     )
 
 
+def init_worker():
+    # Ctrl+C is handled by the main process, which stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Worker processes append to the same log as the main process
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        datefmt=LOG_DATE_FORMAT,
+        handlers=[
+            logging.FileHandler(LOG_FILE),
+            logging.StreamHandler(),
+        ],
+    )
+
+
 # Global Configuration
 METADATA_HEADER = f"MySmartPlans MetaData Tracker v{__version__}\n\n"
 EXIFTOOL_PATH = "./exiftool-13.09_64/exiftool"
+EXIFTOOL_TIMEOUT = 30  # Seconds to wait for ExifTool before restarting it
+EXIFTOOL_CHUNK_SIZE = 200  # Files per ExifTool call when extracting in batches
+
+# Only the tags used by format_metadata are requested from ExifTool
+EXIFTOOL_TAGS = (
+    "GPSLatitude",
+    "GPSLongitude",
+    "GPSLatitudeRef",
+    "GPSLongitudeRef",
+    "DateTimeOriginal",
+    "OffsetTime",
+    "Orientation",
+    "Make",
+    "Model",
+    "ImageWidth",
+    "ImageHeight",
+    "Megapixels",
+)
+
+# Metadata backend
+METADATA_BACKEND = "in-process"  # Choose (in-process or exiftool)
+HEADER_READ_BYTES = 256 * 1024  # Bytes read per file by the in-process backend
+# Files missing any of these after the in-process read are sent to ExifTool
+REQUIRED_METADATA_TAGS = ("Origin Date", "Image Width", "Image Height")
+
+# ExifTool's names for the EXIF orientation values
+ORIENTATION_NAMES = {
+    1: "Horizontal (normal)",
+    2: "Mirror horizontal",
+    3: "Rotate 180",
+    4: "Mirror vertical",
+    5: "Mirror horizontal and rotate 270 CW",
+    6: "Rotate 90 CW",
+    7: "Mirror horizontal and rotate 90 CW",
+    8: "Rotate 270 CW",
+}
+ORIENTATION_VALUES = {name: value for value, name in ORIENTATION_NAMES.items()}
+# How to turn each EXIF orientation upright
+ORIENTATION_TRANSPOSES = {  # Names of Pillow's Image.Transpose members
+    2: "FLIP_LEFT_RIGHT",
+    3: "ROTATE_180",
+    4: "FLIP_TOP_BOTTOM",
+    5: "TRANSPOSE",
+    6: "ROTATE_270",
+    7: "TRANSVERSE",
+    8: "ROTATE_90",
+}
+
+# Image types picked up from the input directory
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".heic")
+SKIPPED_SUFFIXES = (
+    "_MD.png",
+    "_MD.jpg",
+    "_MD.webp",
+    "_MD.heic",
+    "_MD.txt",
+    "_temp.jpg",
+)
+SCAN_INCLUDE = ()  # Glob patterns, only matching files are processed when set
+SCAN_EXCLUDE = ()  # Glob patterns for files and directories to leave alone
+SCAN_MAX_DEPTH = None  # Subdirectory levels to descend into, None for all
+SCAN_BATCH_SIZE = 200  # Scanned images handed to the pipeline at a time
+
+# Staged pipeline (--pipeline)
+PIPELINE_QUEUE_SIZE = 16  # Images waiting between the render, write and cleanup stages
+PIPELINE_SCAN_BATCHES = 2  # Scanned batches waiting for metadata extraction
+
+# Processing journal used to resume interrupted runs
+JOURNAL_FILENAME = "processing_journal.jsonl"
+PARTIAL_SUFFIX = ".partial"  # Outputs are written under this suffix, then renamed
+
+# Sharded runs (--shard), several processes or machines sharing the directories
+CLAIMS_DIRECTORY = ".claims"  # Inside the output directory, one claim file per image
+CLAIM_STALE_SECONDS = 3600  # Claims older than this are taken over by other shards
+
+# Watch mode
+WATCH_POLL_INTERVAL = 2.0  # Seconds between scans when inotify is unavailable
+WATCH_RESCAN_INTERVAL = 60.0  # Safety rescan with inotify, e.g. for network shares
+WATCH_SETTLE_SECONDS = 3.0  # How long a file must stay unchanged before processing
+WATCH_QUEUE_SIZE = 64  # Images waiting to be processed before the watcher waits
+TIMING_RESERVOIR_SIZE = 2048  # Stage times sampled for the watch mode percentiles
 
 # File tracking
-METADATA_FORMAT = "xlsx"  # Choose (txt or xlsx)
+METADATA_FORMAT = "xlsx"  # Choose (txt, xlsx, csv, jsonl or parquet)
 CREATE_METADATA_FILE = True
 WRITE_RAW_METADATA = False
 
+# Metadata cache, kept next to the output directory so it survives clearing it
+USE_METADATA_CACHE = True
+CACHE_FILENAME = "metadata_cache.sqlite"
+CACHE_MAX_ENTRIES = 200000  # Least recently used entries are evicted above this
+CACHE_HASH_BYTES = 64 * 1024  # Bytes hashed from the start and end of each file
+CACHE_FORMAT_VERSION = 2  # Raise when the cached metadata changes shape
+
+# Duplicate detection (--duplicates)
+DUPLICATE_ACTION = None  # skip, link or render; None turns detection off
+DUPLICATE_INDEX_FILENAME = "fingerprint_index.sqlite"
+DUPLICATE_HASH_DISTANCE = 3  # Differing perceptual hash bits for a near duplicate
+FINGERPRINT_DECODE_SIZE = 64  # Longest side decoded for the perceptual hash
+FINGERPRINT_MIN_DETAIL = 8  # Set hash bits below which an image is too flat to compare
+
+# Columns of the xlsx report
+XLSX_COLUMNS = (
+    "Filename",
+    "File Path",
+    "Origin Date",
+    "Offset Time",
+    "Orientation",
+    "Make",
+    "Model",
+    "File Size",
+    "File Type",
+    "GPS Latitude",
+    "GPS Longitude",
+    "Image Width",
+    "Image Height",
+    "Megapixels",
+)
+# Added when duplicate detection is on
+XLSX_DUPLICATE_COLUMNS = ("Duplicate Group", "Duplicate Of")
+
+# Typed columns of the csv, jsonl and parquet reports
+REPORT_FIELDS = (
+    "filename",
+    "file_path",
+    "file_type",
+    "file_size",
+    "origin_date",
+    "offset_time",
+    "orientation",
+    "make",
+    "model",
+    "latitude",
+    "longitude",
+    "image_width",
+    "image_height",
+    "megapixels",
+    "duplicate_group",
+    "duplicate_of",
+)
+PARQUET_BATCH_SIZE = 10000  # Rows buffered per parquet row group
+
+# Spatial index written next to the report, needs numpy
+SPATIAL_INDEX = True
+SPATIAL_INDEX_SUFFIX = "_gps.npz"  # IMAGES_IN_MD.csv -> IMAGES_IN_MD_gps.npz
+SPATIAL_CELL_DEGREES = 0.01  # Grid cell size, about 1.1 km north to south
+EARTH_RADIUS_METRES = 6371008.8
+
 # Dynamic Padding Configuration
 PADDING_LEFT_FACTOR = 0.03
 PADDING_RIGHT_FACTOR = 0.50
@@ -66,6 +251,49 @@ PADDING_TOP_FACTOR = 0.02
 PADDING_BOTTOM_FACTOR = 0.01
 
 NO_METADATA_MESSAGE = "No Metadata Available\n"
+LABEL_LINE_SPACING = 4  # Pixels between label lines, as Pillow's multiline text
+
+# Stamped image output
+OUTPUT_FORMAT = "png"  # Choose (png, jpeg, webp or source to keep the input format)
+OUTPUT_QUALITY = 90  # JPEG, WebP and HEIC quality, 1-100
+PNG_COMPRESS_LEVEL = 6  # 0 (fastest, largest) to 9 (slowest, smallest)
+KEEP_EXIF = False  # Copy the EXIF data of the source into stamped images
+KEEP_ICC_PROFILE = True  # Copy the color profile of the source
+OUTPUT_ENCODERS = {  # output format -> (Pillow format, file extension)
+    "png": ("PNG", ".png"),
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "heic": ("HEIF", ".heic"),
+}
+SOURCE_OUTPUT_FORMATS = {
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".png": "png",
+    ".heic": "heic",
+}
+EXIF_ORIENTATION_TAG = 0x0112  # ExifTags.Base.Orientation
+MAX_DIMENSION = None  # Longest side of stamped images in pixels, None for full size
+
+# HEIC decoding
+HEIC_DECODE_THREADS = 4  # libheif threads per process, split between --workers
+HEIC_PRIMARY_IMAGE_ONLY = True  # Skip depth maps and auxiliary images
+
+# Memory budget for parallel renders (--memory-budget)
+MEMORY_BUDGET = None  # Megabytes, None for a share of the memory limit, 0 for none
+MEMORY_BUDGET_SHARE = 0.5  # Of the container limit or physical memory
+RENDER_BYTES_PER_PIXEL = 6  # Peak memory of a render per image pixel, see benchmarks
+
+# Overlay font. A bare file name is also looked up in the system font folders;
+# when neither it nor a fallback is found, Pillow's bundled font is used.
+FONT_PATH = "arial.ttf"
+FALLBACK_FONT_PATHS = ("DejaVuSans.ttf", "LiberationSans-Regular.ttf")
+
+OVERLAY_NATIVE_MODES = (
+    "RGB",
+    "RGBA",
+    "L",
+    "LA",
+)  # Labels are pasted without converting
 
 OVERLAY_POSITIONS = {1: "top-left", 2: "top-right", 3: "bottom-left", 4: "bottom-right"}
 
@@ -97,75 +325,231 @@ def format_filesize_kb(filesize_bytes):
 
 
 def convert_gps_to_dms(coordinates, reference):
-    if coordinates is None or isinstance(coordinates, str):
-        return coordinates or "GPS Data not found"
-
-    def calculate_dms(data):
-        if isinstance(data, list):
-            return sum(float(x) for x in data)
-        elif isinstance(data, Ratio):  # Check for Ratio objects
-            return float(data)
-        else:
-            raise ValueError("Unexpected data type in GPS coordinates")
+    # Accepts ExifTool's text (39 deg 5' 30.50" N), exifread tags or a
+    # degrees, minutes, seconds sequence. ExifTool spells the reference
+    # out (North), only its first letter is used.
+    reference = str(reference or "").strip()[:1].upper()
+    if coordinates is None or coordinates == "":
+        return "GPS Data not found"
+    if isinstance(coordinates, str):
+        if reference and not re.search(r"[NSEW]\s*$", coordinates):
+            return f"{coordinates} {reference}"
+        return coordinates
 
-    degrees = calculate_dms(coordinates.values[0] if coordinates else None)
-    minutes = calculate_dms(coordinates.values[1] if coordinates else None) / 60
-    seconds = calculate_dms(coordinates.values[2] if coordinates else None) / 3600
+    values = getattr(coordinates, "values", coordinates)
+    if isinstance(values, (int, float, Ratio)):
+        return f"{float(values):.7f}"
+    if len(values) != 3:
+        raise ValueError("Unexpected data type in GPS coordinates")
+    return format_exiftool_dms(values, reference)
 
-    return f"{degrees:.1f}° {minutes:.3f}' {seconds:.4f}\" {reference}"
 
+heif_opener_registered = False
 
-def process_heic(image_path, text, output_directory, overlay_position):
-    try:
-        # Register the HEIF opener with Pillow
-        pillow_heif.register_heif_opener()
-
-        # Pass the image to overlay_text for further processing and saving
-        overlay_text(
-            image_path=image_path,
-            text=text,
-            position=(10, 10),
-            output_directory=output_directory,
-            overlay_position=overlay_position,
+
+def register_heif_opener(decode_threads=None):
+    # Registers the HEIF plugin with Pillow the first time a HEIC file is seen
+    # in this process instead of for every file
+    global heif_opener_registered
+    if heif_opener_registered:
+        return
+    import pillow_heif
+
+    pillow_heif.register_heif_opener(
+        decode_threads=decode_threads or HEIC_DECODE_THREADS,
+        depth_images=not HEIC_PRIMARY_IMAGE_ONLY,
+        aux_images=not HEIC_PRIMARY_IMAGE_ONLY,
+    )
+    heif_opener_registered = True
+
+
+def is_heic_file(filepath):
+    return filepath.lower().endswith(".heic")
+
+
+def get_exiftool_path():
+    if getattr(sys, "frozen", False):
+        # ExifTool is bundled into the PyInstaller build
+        return os.path.join(sys._MEIPASS, "exiftool-13.09_64", "exiftool.exe")
+
+    # Prefer a copy next to the script, then whatever is on the PATH
+    local_path = os.path.join(get_base_path(), EXIFTOOL_PATH)
+    if os.path.isfile(local_path):
+        return local_path
+    return shutil.which("exiftool") or EXIFTOOL_PATH
+
+
+class ExifToolSession:
+    """Long-lived ExifTool process driven through ``-stay_open True -@ -``.
+
+    Arguments are streamed over stdin and each command is terminated with
+    ``-executeN``; ExifTool answers with the command output followed by a
+    ``{readyN}`` line. The process is started on first use and restarted
+    if it crashes or stops responding.
+    """
+
+    def __init__(self, exiftool_path=None, timeout=EXIFTOOL_TIMEOUT):
+        self.exiftool_path = exiftool_path or get_exiftool_path()
+        self.timeout = timeout
+        self._process = None
+        self._lines = None
+        self._counter = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        self._process = subprocess.Popen(
+            [self.exiftool_path, "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
         )
+        # Responses are read on background threads so a stuck ExifTool can
+        # be detected with a timeout on every platform (pipes are not
+        # selectable on Windows)
+        self._lines = queue.Queue()
+        threading.Thread(
+            target=self._read_stdout,
+            args=(self._process.stdout, self._lines),
+            daemon=True,
+        ).start()
+        threading.Thread(
+            target=self._read_stderr, args=(self._process.stderr,), daemon=True
+        ).start()
+        logging.info(f"Started ExifTool session: {self.exiftool_path}")
 
-        logging.info(f"Successfully processed HEIC file: {image_path}")
+    @staticmethod
+    def _read_stdout(stream, lines):
+        for line in stream:
+            lines.put(line)
+        lines.put(None)  # ExifTool exited
 
-    except Exception as e:
-        logging.error(f"Error processing HEIC file: {image_path} - Error: {e}")
+    @staticmethod
+    def _read_stderr(stream):
+        for line in stream:
+            if line.strip():
+                logging.warning(f"ExifTool: {line.strip()}")
 
+    def restart(self):
+        self._kill()
+        self.start()
 
-def get_image_metadata(image_path):
-    try:
-        # Construct the ExifTool command with the updated path
-        # command = [EXIFTOOL_PATH, "-j", image_path]  # -j for JSON output
+    def execute(self, *args):
+        if not self.running:
+            self.start()
+
+        self._counter += 1
+        ready = f"{{ready{self._counter}}}"
+        command = "\n".join(
+            ("-charset", "filename=utf8") + args + (f"-execute{self._counter}",)
+        )
 
-        exiftool_path = os.path.join(sys._MEIPASS, "exiftool-13.09_64", "exiftool.exe")
-        command = [exiftool_path, "-j", image_path]
+        try:
+            self._process.stdin.write(command + "\n")
+            self._process.stdin.flush()
+        except OSError as e:
+            self._kill()
+            raise RuntimeError(f"ExifTool is not accepting commands: {e}")
+
+        output = []
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self._kill()
+                raise TimeoutError(
+                    f"ExifTool did not respond within {self.timeout} seconds"
+                )
 
-        # Execute the command and capture the output
-        process = subprocess.run(command, capture_output=True, text=True)
+            if line is None:
+                self._kill()
+                raise RuntimeError("ExifTool exited unexpectedly")
+            if line.rstrip() == ready:
+                return "".join(output)
+            output.append(line)
 
-        # Check if there's any output from ExifTool
-        if not process.stdout:
+    def get_metadata(self, image_path):
+        output = self.execute("-j", image_path)
+        if not output:
             raise ValueError("No output from ExifTool")
+        return json.loads(output)[0]
 
-        # Parse the JSON output
-        metadata = json.loads(process.stdout)[0]
-
-        # Format the metadata (adjust as needed based on ExifTool's output)
-        formatted_metadata = {
-            "GPS Latitude": metadata.get("GPSLatitude", ""),
-            "GPS Longitude": metadata.get("GPSLongitude", ""),
-            "Origin Date": parse_image_date(metadata.get("DateTimeOriginal", "")),
-            "Offset Time": metadata.get("OffsetTime", ""),
-            "Orientation": metadata.get("Orientation", ""),
-            "Make": metadata.get("Make", ""),
-            "Model": metadata.get("Model", ""),
-            "Image Width": metadata.get("ImageWidth", ""),
-            "Image Height": metadata.get("ImageHeight", ""),
-            "Megapixels": metadata.get("Megapixels", ""),  # Now directly available
-        }
+    def close(self):
+        if not self.running:
+            self._process = None
+            return
+
+        try:
+            self._process.stdin.write("-stay_open\nFalse\n")
+            self._process.stdin.flush()
+            self._process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self._kill()
+        self._process = None
+
+    def _kill(self):
+        if self._process is None:
+            return
+
+        if self._process.poll() is None:
+            self._process.kill()
+        try:
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        logging.warning("ExifTool session stopped")
+        self._process = None
+
+
+def format_metadata(metadata):
+    # Format the metadata (adjust as needed based on ExifTool's output)
+    return {
+        "GPS Latitude": metadata.get("GPSLatitude", ""),
+        "GPS Longitude": metadata.get("GPSLongitude", ""),
+        "GPS GPSLatitudeRef": metadata.get("GPSLatitudeRef", ""),
+        "GPS GPSLongitudeRef": metadata.get("GPSLongitudeRef", ""),
+        "Origin Date": parse_image_date(metadata.get("DateTimeOriginal", "")),
+        "Offset Time": metadata.get("OffsetTime", ""),
+        "Orientation": metadata.get("Orientation", ""),
+        "Make": metadata.get("Make", ""),
+        "Model": metadata.get("Model", ""),
+        "Image Width": metadata.get("ImageWidth", ""),
+        "Image Height": metadata.get("ImageHeight", ""),
+        "Megapixels": metadata.get("Megapixels", ""),  # Now directly available
+    }
+
+
+def get_image_metadata(image_path, session=None):
+    try:
+        if session is not None:
+            # Reuse the running ExifTool process
+            metadata = session.get_metadata(image_path)
+        else:
+            command = [get_exiftool_path(), "-j", image_path]  # -j for JSON output
+
+            # Execute the command and capture the output
+            process = subprocess.run(command, capture_output=True, text=True)
+
+            # Check if there's any output from ExifTool
+            if not process.stdout:
+                raise ValueError("No output from ExifTool")
+
+            # Parse the JSON output
+            metadata = json.loads(process.stdout)[0]
+
+        formatted_metadata = format_metadata(metadata)
 
         return formatted_metadata, metadata  # Return both formatted and raw metadata
 
@@ -174,474 +558,4142 @@ def get_image_metadata(image_path):
         return {}
 
 
-def write_raw_metadata(raw_metadata, output_path):
-    if WRITE_RAW_METADATA:
-        with open(output_path, "w") as f:
-            for key, value in raw_metadata.items():
-                f.write(f"{key}: {value}\n")
+def is_image_file(filepath):
+    # Exclude temporary JPEG files and our own output from processing
+    return filepath.lower().endswith(IMAGE_EXTENSIONS) and not filepath.endswith(
+        SKIPPED_SUFFIXES
+    )
 
 
-def write_metadata(metadata, output_path):
-    if METADATA_FORMAT == "txt":
-        with open(output_path, "w") as f:
-            f.write(METADATA_HEADER)
-            f.write(f"Filename: {os.path.basename(output_path)}\n")
-            f.write("\n")
-            for file_info in metadata["files"]:
-                f.write(f"Filename: {file_info['filename']}\n")
-                f.write(f"File Size: {format_filesize_kb(file_info['file_size'])}\n")
-                f.write(f"File Type: {file_info['file_type']}\n")
-                f.write(f"File Path: {file_info['file_path']}\n")
-                # Write metadata values if present
-                f.write(f"Make: {file_info['metadata'].get('Make')}\n")
-                f.write(f"Model: {file_info['metadata'].get('Model')}\n")
-                lat_ref = file_info["metadata"].get("GPS GPSLatitudeRef") or "N"
-                latitude = convert_gps_to_dms(
-                    file_info["metadata"].get("GPS Latitude"), lat_ref
-                )
-                f.write(f"Latitude: {latitude}\n")
-                lon_ref = file_info["metadata"].get("GPS GPSLongitudeRef") or "E"
-                longitude = convert_gps_to_dms(
-                    file_info["metadata"].get("GPS Longitude"), lon_ref
-                )
-                f.write(f"Longitude: {longitude}\n")
-                f.write(f"Origin Date: {file_info['metadata'].get('Origin Date')}\n")
-                f.write(f"Orientation: {file_info['metadata'].get('Orientation')}\n")
-                f.write(f"Image Width: {file_info['metadata'].get('Image Width')}\n")
-                f.write(f"Image Height: {file_info['metadata'].get('Image Height')}\n")
-                f.write(f"Offset Time: {file_info['metadata'].get('Offset Time')}\n")
-                f.write(f"Megapixels: {file_info['metadata'].get('Megapixels')}\n")
-                f.write("\n")
-
-    elif METADATA_FORMAT == "xlsx":
-        try:
-            # Attempt to load existing workbook
-            wb = openpyxl.load_workbook(output_path)
-            sheet = wb.active
-        except FileNotFoundError:
-            # Workbook doesn't exist, create headers
-            wb = openpyxl.Workbook()
-            sheet = wb.active
-            row = 1
-            sheet.cell(row, 1).value = "Filename"
-            sheet.cell(row, 2).value = "File Path"
-            sheet.cell(row, 3).value = "Origin Date"
-            sheet.cell(row, 4).value = "Offset Time"
-            sheet.cell(row, 5).value = "Orientation"
-            sheet.cell(row, 6).value = "Make"
-            sheet.cell(row, 7).value = "Model"
-            sheet.cell(row, 8).value = "File Size"
-            sheet.cell(row, 9).value = "File Type"
-            sheet.cell(row, 10).value = "GPS Latitude"
-            sheet.cell(row, 11).value = "GPS Longitude"
-            sheet.cell(row, 12).value = "Image Width"
-            sheet.cell(row, 13).value = "Image Height"
-            sheet.cell(row, 14).value = "Megapixels"
-
-        # Process file info from the metadata
-        for file_info in metadata["files"]:
-            row = sheet.max_row + 1
+def build_exiftool_args(image_paths):
+    args = ["-j", "-fast2"]
+    if not WRITE_RAW_METADATA:
+        # The raw metadata file needs every tag, otherwise ask for ours only
+        args += [f"-{tag}" for tag in EXIFTOOL_TAGS]
+    return args + list(image_paths)
 
-            sheet.cell(row, 1).value = file_info["filename"]
-            sheet.cell(row, 2).value = file_info["file_path"]
 
-            # Convert 'Origin Date'
-            origin_date = file_info["metadata"].get("Origin Date")
-            if origin_date:
-                formatted_date = parse_image_date(origin_date)
-                sheet.cell(row, 3).value = formatted_date
+def run_exiftool_batch(image_paths, session=None):
+    args = build_exiftool_args(image_paths)
+    if session is not None:
+        return session.execute(*args)
 
-            # Convert 'Offset Time'
-            offset_time = file_info["metadata"].get("Offset Time")
-            if isinstance(offset_time, str):
-                sheet.cell(row, 4).value = offset_time
-            else:
-                sheet.cell(row, 4).value = str(offset_time)
-            sheet.cell(row, 5).value = str(file_info["metadata"].get("Orientation"))
-
-            # Handle potential None or invalid characters
-            make = file_info["metadata"].get("Make")
-            if make:
-                make = make.encode("ascii", errors="ignore").decode()
-                sheet.cell(row, 6).value = make
-
-            # Handle potential None or invalid characters
-            model = file_info["metadata"].get("Model")
-            if model:
-                model = model.encode("ascii", errors="ignore").decode()
-                sheet.cell(row, 7).value = model
-            sheet.cell(row, 8).value = format_filesize_kb(file_info["file_size"])
-            sheet.cell(row, 9).value = file_info["file_type"]
-            sheet.cell(row, 10).value = str(file_info["metadata"].get("GPS Latitude"))
-            sheet.cell(row, 11).value = str(file_info["metadata"].get("GPS Longitude"))
-            image_width = file_info["metadata"].get("Image Width")
-            if image_width:
-                # sheet.cell(row, 12).value = int(image_width.printable)
-                sheet.cell(row, 12).value = int(str(image_width))
-            image_height = file_info["metadata"].get("Image Height")
-            if image_height:
-                # sheet.cell(row, 13).value = int(image_height.printable)
-                sheet.cell(row, 13).value = int(str(image_height))
-            megapixels = file_info["metadata"].get("Megapixels")
-            if megapixels:
-                # sheet.cell(row, 14).value = float(megapixels.printable)
-                sheet.cell(row, 14).value = float(str(megapixels))
-
-        wb.save(output_path)
-        for column_cells in sheet.columns:
-            length = max(len(str(cell.value)) for cell in column_cells)
-            column_letter = column_cells[0].column_letter
-            sheet.column_dimensions[column_letter].width = length
-        wb.save(output_path)
+    # Pass the arguments on stdin to stay clear of command line length limits
+    process = subprocess.run(
+        [get_exiftool_path(), "-charset", "filename=utf8", "-@", "-"],
+        input="\n".join(args) + "\n",
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    )
+    return process.stdout
 
-    else:
-        raise ValueError("Unsupported format")
 
+def normalize_source_path(path):
+    # ExifTool reports SourceFile with forward slashes
+    return os.path.normcase(os.path.normpath(path))
 
-def open_image_without_orientation(image_path):
-    try:
-        img = Image.open(image_path)
-
-        # Skip orientation check for HEIC files
-        if not image_path.lower().endswith(".heic"):
-            exif = img.getexif()
-            orientation = 1
-            for orientation in ExifTags.TAGS.keys():
-                if ExifTags.TAGS[orientation] == "Orientation":
-                    break
-
-            if exif[orientation] == 2:  # Horizontal flip
-                img = img.transpose(Image.FLIP_LEFT_RIGHT)
-            elif exif[orientation] == 3:  # 180 degree rotation
-                img = img.transpose(Image.ROTATE_180)
-            elif exif[orientation] == 4:  # Vertical flip
-                img = img.transpose(Image.FLIP_TOP_BOTTOM)
-            elif exif[orientation] == 5:  # Transpose (90 degree rotation + flip)
-                img = img.transpose(Image.TRANSPOSE)
-            elif exif[orientation] == 6:  # 90 degree rotation
-                img = img.transpose(Image.ROTATE_270)
-            elif exif[orientation] == 7:  # Transpose (270 degree rotation + flip)
-                img = img.transpose(Image.TRANSVERSE)
-            elif exif[orientation] == 8:  # 270 degree rotation
-                img = img.transpose(Image.ROTATE_90)
 
-        return img
+def get_images_metadata(image_paths, chunk_size=EXIFTOOL_CHUNK_SIZE, session=None):
+    # Returns {image_path: (formatted_metadata, raw_metadata)}; files ExifTool
+    # could not read are left out
+    image_paths = list(image_paths)
+    results = {}
 
-    except (KeyError, AttributeError, OSError):
-        # exif data missing or image corrupt
-        print(f"Image file might be corrupt or missing EXIF data: {image_path}")
-        return Image.open(image_path)
+    for start in range(0, len(image_paths), chunk_size):
+        chunk = image_paths[start : start + chunk_size]
+        try:
+            output = run_exiftool_batch(chunk, session=session)
+            entries = json.loads(output) if output.strip() else []
+        except Exception as e:
+            logging.error(f"ExifTool failed on a batch of {len(chunk)} files: {e}")
+            if len(chunk) == 1:
+                continue
 
+            # Isolate the file that broke the batch
+            for image_path in chunk:
+                metadata = get_image_metadata(image_path, session=session)
+                if metadata:
+                    results[image_path] = metadata
+            continue
 
-def overlay_text(
-    image_path,
-    text,
-    position,
-    output_directory,
-    overlay_position="top-left",
-    color=(0, 0, 0),
-    background_color=(255, 255, 255, 128),
-):
-    img = open_image_without_orientation(image_path).convert("RGBA")
+        by_source = {
+            normalize_source_path(entry["SourceFile"]): entry
+            for entry in entries
+            if "SourceFile" in entry
+        }
+        for image_path in chunk:
+            metadata = by_source.get(normalize_source_path(image_path))
+            if metadata is not None:
+                results[image_path] = (format_metadata(metadata), metadata)
 
-    # Create a new image for semi-transparent overlay
-    overlay = Image.new("RGBA", img.size, (255, 255, 255, 0))
-    overlay_draw = ImageDraw.Draw(overlay)
+    return results
 
-    width, height = img.size
 
-    # Dynamic Font Scaling
-    font_size = max(
-        12, int(height * 0.02)
-    )  # Base size of 12, scales with 2% of image height
-    font = ImageFont.truetype("arial.ttf", font_size)
+def exiftool_available():
+    exiftool_path = get_exiftool_path()
+    return os.path.isfile(exiftool_path) or shutil.which(exiftool_path) is not None
 
-    # Dynamic Padding
-    padding_left = int(min(width, height) * PADDING_LEFT_FACTOR)
-    padding_right = int(padding_left * PADDING_RIGHT_FACTOR)
-    padding_top = int(height * PADDING_TOP_FACTOR)
-    padding_bottom = int(height * PADDING_BOTTOM_FACTOR)
 
-    if not text:
-        text = NO_METADATA_MESSAGE
+def format_exiftool_dms(values, reference):
+    # Same layout as ExifTool's composite GPS tags, e.g. 39 deg 5' 30.50" N
+    degrees, minutes, seconds = (float(value) for value in values)
+    return f"{int(degrees)} deg {int(minutes)}' {seconds:.2f}\" {reference}"
 
-    text = METADATA_HEADER + text
 
-    text_width, text_height = overlay_draw.textbbox((0, 0), text, font=font)[2:]
+def format_megapixels(width, height):
+    # ExifTool rounds to one decimal place from 1 MP upwards
+    megapixels = width * height / 1000000
+    return round(megapixels, 1 if megapixels >= 1 else 3)
 
-    if overlay_position == "top-left":
-        text_position = (position[0], position[1])
-    elif overlay_position == "top-right":
-        text_position = (width - text_width - padding_right, position[1])
-    elif overlay_position == "bottom-left":
-        text_position = (position[0], height - text_height - padding_bottom)
-    elif overlay_position == "bottom-right":
-        text_position = (
-            width - text_width - padding_right,
-            height - text_height - padding_bottom,
-        )
 
-    overlay_draw.rectangle(
-        (
-            (text_position[0] - padding_left, text_position[1] - padding_top),
-            (
-                text_position[0] + text_width + padding_right,
-                text_position[1] + text_height + padding_bottom,
-            ),
-        ),
-        fill=background_color,
-    )
-    overlay_draw.text((text_position[0], text_position[1]), text, fill=color, font=font)
+def add_pillow_exif(metadata, exif):
+    # The tags read_header_metadata takes from exifread, from a Pillow Exif
+    exif_ifd = exif.get_ifd(0x8769)
+    gps_ifd = exif.get_ifd(0x8825)
+    for key, value in (
+        ("DateTimeOriginal", exif_ifd.get(0x9003)),
+        ("OffsetTime", exif_ifd.get(0x9010)),
+        ("Make", exif.get(0x010F)),
+        ("Model", exif.get(0x0110)),
+    ):
+        if isinstance(value, str) and value.strip("\x00 "):
+            metadata[key] = value.strip("\x00 ")
 
-    cropped_overlay = overlay.crop(
-        (
-            text_position[0] - padding_left,
-            text_position[1] - padding_top,
-            text_position[0] + text_width + padding_right,
-            text_position[1] + text_height + padding_bottom,
+    if exif.get(EXIF_ORIENTATION_TAG):
+        metadata["Orientation"] = ORIENTATION_NAMES.get(
+            exif[EXIF_ORIENTATION_TAG], "Unknown"
         )
-    )
 
-    # Paste only the cropped area onto the original image
-    img.paste(
-        cropped_overlay,
-        (text_position[0] - padding_left, text_position[1] - padding_top),
-        mask=cropped_overlay,
-    )
+    for key, reference_tag, value_tag, default in (
+        ("GPSLatitude", 1, 2, "N"),
+        ("GPSLongitude", 3, 4, "E"),
+    ):
+        coordinates = gps_ifd.get(value_tag)
+        if coordinates is not None and len(coordinates) == 3:
+            reference = str(gps_ifd.get(reference_tag) or default).strip("\x00 ")
+            metadata[key] = format_exiftool_dms(coordinates, reference)
+            metadata[key + "Ref"] = reference
 
-    date_match = re.search(r"Date/Time: (\d{4}-\d{2}-\d{2})", text)
-    if date_match:
-        date_str = date_match.group(1)  # Extract the date string
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d")  # Convert to datetime object
-        date_folder = date_obj.strftime("%m-%d-%Y")
-    else:
-        date_folder = datetime.now().strftime(
-            "%m-%d-%Y"
-        )  # Fallback to current date if not found
 
-    date_folder_path = os.path.join(output_directory, date_folder)
-    os.makedirs(date_folder_path, exist_ok=True)
+def read_header_metadata(image_path, header_bytes=HEADER_READ_BYTES):
+    # EXIF and the image size live at the start of the file, so only the
+    # header is read instead of the full image
+    from exifread import process_file
 
-    # Save to output directory
-    filename = os.path.basename(image_path)
-    new_name = os.path.splitext(filename)[0] + "_MD.png"
-    output_path = os.path.join(date_folder_path, new_name)
-    img.save(output_path)
-    # time.sleep(2)
-    os.remove(image_path)
+    with open(image_path, "rb") as f:
+        header = f.read(header_bytes)
 
+    try:
+        tags = process_file(io.BytesIO(header), details=False)
+    except Exception as e:
+        # exifread cannot parse every container, e.g. some HEIC files; the
+        # EXIF is then read through Pillow below
+        logging.debug(f"exifread could not read {image_path}: {e}")
+        tags = {}
+    metadata = {"SourceFile": image_path}
 
-def check_and_clear_directory(directory):
-    if os.path.exists(directory):
-        if os.listdir(directory):  # Check if the directory is not empty
-            response = input(
-                f"Directory {directory} is not empty. Delete all contents? (y/n, default y): "
-            )
-            if response.lower() != "n":
-                # Clear the directory
-                for filename in os.listdir(directory):
-                    file_path = os.path.join(directory, filename)
-                    try:
-                        if os.path.isfile(file_path) or os.path.islink(file_path):
-                            os.unlink(file_path)
-                        elif os.path.isdir(file_path):
-                            shutil.rmtree(file_path)
-                        logging.info(f"All contents of {directory} have been deleted.")
-                    except PermissionError:
-                        logging.warning(
-                            f"Could not delete file {file_path} because it is being used by another process."
-                        )
-                        print(
-                            f"\nError: Could not delete {file_path}. Please ensure the file is closed and not being used by any other program.\n"
-                        )
-                        input("Press Enter to continue...")
-            else:
-                logging.error("Operation aborted by the user.")
-                return False
+    def tag_text(name):
+        tag = tags.get(name)
+        return str(tag.values).strip() if tag is not None else ""
+
+    for key, name in (
+        ("DateTimeOriginal", "EXIF DateTimeOriginal"),
+        ("OffsetTime", "EXIF OffsetTime"),
+        ("Make", "Image Make"),
+        ("Model", "Image Model"),
+    ):
+        value = tag_text(name)
+        if value:
+            metadata[key] = value
+
+    orientation = tags.get("Image Orientation")
+    if orientation is not None and orientation.values:
+        metadata["Orientation"] = ORIENTATION_NAMES.get(
+            orientation.values[0], "Unknown"
+        )
+
+    for key, name in (
+        ("GPSLatitude", "GPS GPSLatitude"),
+        ("GPSLongitude", "GPS GPSLongitude"),
+    ):
+        coordinates = tags.get(name)
+        if coordinates is not None and len(coordinates.values) == 3:
+            reference = tag_text(name + "Ref") or ("N" if key == "GPSLatitude" else "E")
+            metadata[key] = format_exiftool_dms(coordinates.values, reference)
+            metadata[key + "Ref"] = reference
+
+    # Pillow only parses the header here, no pixel data is decoded. HEIC
+    # files may keep their item boxes past the header, so the file itself is
+    # tried next.
+    size = None
+    for source in (io.BytesIO(header), image_path):
+        try:
+            if is_heic_file(image_path):
+                register_heif_opener()
+            with open_image(source) as img:
+                size = img.size
+                if not tags:
+                    add_pillow_exif(metadata, img.getexif())
+            break
+        except Exception:
+            continue
+
+    if size is not None:
+        width, height = size
     else:
-        os.makedirs(directory, exist_ok=True)
-    return True
+        width = tags.get("EXIF ExifImageWidth")
+        height = tags.get("EXIF ExifImageLength")
+        width = width.values[0] if width is not None and width.values else None
+        height = height.values[0] if height is not None and height.values else None
 
+    if width and height:
+        metadata["ImageWidth"] = width
+        metadata["ImageHeight"] = height
+        metadata["Megapixels"] = format_megapixels(width, height)
 
-def main():
-    setup_logging()
+    return format_metadata(metadata), metadata
 
-    base_path = get_base_path()
 
-    # input_directory = r"E:\Python\xPDFTestFiles\IMAGES_IN"
-    # output_directory = r"E:\Python\xPDFTestFiles\IMAGES_OUT"
-    # error_directory = r"E:\Python\xPDFTestFiles\IMAGES_ERROR"
+class MetadataBackend:
+    # Maps a list of image paths to {image_path: (formatted, raw)}
+    name = None
+    # Paths of the last extract() whose results are known to be incomplete
+    # and must not be cached
+    partial_paths = frozenset()
 
-    input_directory = os.path.join(base_path, "IMAGES_IN")
-    output_directory = os.path.join(base_path, "IMAGES_OUT")
-    error_directory = os.path.join(base_path, "IMAGES_ERROR")
-
-    # User selects the overlay position
-    print("Choose the orientation of the metadata overlay for this batch of files:")
-    print("1: Top Left (Default)")
-    print("2: Top Right")
-    print("3: Bottom Left")
-    print("4: Bottom Right")
-    overlay_choice = input(
-        "Enter your choice (1-4, or press Enter for default): "
-    ).strip()
-    if not overlay_choice:
-        overlay_choice = "1"
-    overlay_position = OVERLAY_POSITIONS.get(int(overlay_choice), "top-left")
+    @property
+    def cache_tag(self):
+        # Part of the cache key, so results of one backend are never served
+        # for another
+        return self.name
 
-    logging.info(f"Starting Metadata Extractor version {__version__}")
-    logging.info(f"Using overlay position {overlay_choice}")
-    time.sleep(1)
+    def extract(self, image_paths):
+        raise NotImplementedError
 
-    # Check and possibly clear the output directory
-    if not check_and_clear_directory(output_directory):
-        return
-    time.sleep(1)
 
-    # Check and possibly clear the error directory
-    if not check_and_clear_directory(error_directory):
-        return
-    time.sleep(1)
+class ExifToolBackend(MetadataBackend):
+    name = "exiftool"
 
-    if not os.path.exists(input_directory):
-        logging.error(f"Input directory does not exist: {input_directory}")
-        return
+    def __init__(self, session=None, chunk_size=EXIFTOOL_CHUNK_SIZE):
+        self.session = session
+        self.chunk_size = chunk_size
 
-    # Check if there are any Image files in the directory
-    if not any(
-        file.lower().endswith((".jpg", ".jpeg", ".png", ".heic"))
-        for file in os.listdir(input_directory)
-    ):
-        logging.error("No Images found in the input directory.")
-        return
+    def extract(self, image_paths):
+        return get_images_metadata(
+            image_paths, chunk_size=self.chunk_size, session=self.session
+        )
 
-    # Create directory if not exist
-    os.makedirs(output_directory, exist_ok=True)
-    os.makedirs(error_directory, exist_ok=True)
 
-    has_errors = False
+class InProcessBackend(MetadataBackend):
+    name = "in-process"
 
-    directory_metadata = {"files": []}
+    def __init__(self, fallback=None, header_bytes=HEADER_READ_BYTES):
+        self.fallback = fallback
+        self.header_bytes = header_bytes
 
-    for root, dirs, files in os.walk(input_directory):
-        for filename in files:
-            filepath = os.path.join(root, filename)
+    @property
+    def cache_tag(self):
+        # Results without ExifTool may be incomplete, so they are not reused
+        # once ExifTool is installed
+        if self.fallback is None:
+            return self.name
+        return f"{self.name}+{self.fallback.cache_tag}"
+
+    def extract(self, image_paths):
+        results = {}
+        incomplete = []
+        self.partial_paths = set()
+
+        for image_path in image_paths:
             try:
-                logging.info(f"Processing file: {filename}")
+                results[image_path] = read_header_metadata(
+                    image_path, self.header_bytes
+                )
+                formatted_metadata = results[image_path][0]
+                if all(formatted_metadata.get(tag) for tag in REQUIRED_METADATA_TAGS):
+                    continue
+            except Exception as e:
+                logging.warning(f"Could not read header of {image_path}: {e}")
+            incomplete.append(image_path)
 
-                # Exclude temporary JPEG files from processing
-                if filepath.lower().endswith(
-                    (".jpg", ".jpeg", ".png", ".heic")
-                ) and not filepath.endswith(("_MD.png", "_MD.txt", "_temp.jpg")):
-                    formatted_metadata, raw_metadata = get_image_metadata(filepath)
+        if incomplete and self.fallback is not None:
+            logging.info(f"Falling back to ExifTool for {len(incomplete)} file(s)")
+            fallback_results = self.fallback.extract(incomplete)
+            results.update(fallback_results)
+            # What the header gave is still used, but a later run should ask
+            # ExifTool again instead of being served this from the cache
+            self.partial_paths = {
+                path
+                for path in incomplete
+                if path in results and path not in fallback_results
+            }
 
-                    if WRITE_RAW_METADATA:
-                        output_filename = (
-                            os.path.splitext(filename)[0] + "_metadata.txt"
-                        )
-                        output_path = os.path.join(output_directory, output_filename)
-                        write_raw_metadata(raw_metadata, output_path)
-
-                    file_stats = os.stat(filepath)
-                    file_size = file_stats.st_size
-                    file_type = os.path.splitext(filename)[1]
-
-                    directory_metadata["files"].append(
-                        {
-                            "filename": filename,
-                            "metadata": formatted_metadata,
-                            "file_size": file_size,
-                            "file_type": file_type,
-                            "file_path": filepath,
-                        }
-                    )
+        return results
 
-                    overlay_text_content = f"Filename: {os.path.basename(filepath)}\n"
 
-                    if all(value is None for value in formatted_metadata.values()):
-                        overlay_text_content += "No Metadata Available\n"
-                    else:
-                        for key, value in formatted_metadata.items():
-                            if key == "GPS Latitude" and value:
-                                lat_ref = (
-                                    formatted_metadata.get("GPS GPSLatitudeRef") or "N"
-                                )
-                                latitude = convert_gps_to_dms(value, lat_ref)
-                                overlay_text_content += f"Latitude: {latitude}\n"
-                            elif key == "GPS Longitude" and value:
-                                lon_ref = (
-                                    formatted_metadata.get("GPS GPSLongitudeRef") or "E"
-                                )
-                                longitude = convert_gps_to_dms(value, lon_ref)
-                                overlay_text_content += f"Longitude: {longitude}\n"
-                            elif key == "Origin Date" and value:
-                                overlay_text_content += f"Date/Time: {value}\n"
-                            elif key == "Offset Time" and value:
-                                overlay_text_content += f"Offset Time: {value}\n"
-                            elif key == "Orientation" and value:
-                                overlay_text_content += f"Orientation: {value}\n"
-                            elif key == "Make" and value:
-                                overlay_text_content += f"Make: {value}\n"
-                            elif key == "Model" and value:
-                                overlay_text_content += f"Model: {value}\n"
-                            elif key == "Image Width" and value:
-                                image_width = value
-                            elif key == "Image Height" and value and image_width:
-                                overlay_text_content += (
-                                    f"Image Size: {image_width} x {value}\n"
-                                )
-                                image_width = None
-                            elif key == "Megapixel" and value:
-                                overlay_text_content += f"Megapixel: {value}\n"
+def create_metadata_backend(name=METADATA_BACKEND, session=None):
+    exiftool = ExifToolBackend(session) if exiftool_available() else None
 
-                    logging.info(f"Processed file: {filename}")
+    if name == "exiftool":
+        if exiftool is None:
+            raise FileNotFoundError(f"ExifTool not found: {get_exiftool_path()}")
+        return exiftool
 
-                    # Use process_heic for HEIC files, overlay_text for others
-                    if filepath.lower().endswith(".heic"):
-                        process_heic(
-                            filepath,
-                            overlay_text_content,
-                            output_directory,
-                            overlay_position,
-                        )
-                    else:
-                        overlay_text(
-                            filepath,
-                            overlay_text_content,
-                            (10, 10),
-                            output_directory,
-                            overlay_position,
-                        )
-                        logging.info(f"Successfully processed Image file: {filepath}")
+    if name == "in-process":
+        if exiftool is None:
+            logging.warning("ExifTool not found, using in-process metadata only")
+        return InProcessBackend(fallback=exiftool)
 
-            except Exception as e:
-                # Moves files to IMAGES_ERROR
-                # Use copy to avoid deleting test files
-                error_file_path = os.path.join(error_directory, filename)
-                os.rename(filepath, error_file_path)
-                # shutil.copy(filepath, error_file_path)
-
-                logging.error(f"Failed to process {filename}. Error: {e}")
-                print(f"An error occurred: {e}")
-                print(f"Check the error output folder: {error_directory}")
-                input("Press Enter to acknowledge and continue...")
-                has_errors = True
-
-        # Handle metadata file creation
-        if CREATE_METADATA_FILE:
-            working_directory_name = os.path.basename(input_directory)
-            directory_metadata_path = os.path.join(
-                output_directory, working_directory_name + "_MD." + METADATA_FORMAT
+    raise ValueError(f"Unsupported metadata backend: {name}")
+
+
+def compute_file_key(image_path, file_size=None):
+    # Size plus a hash of the first and last CACHE_HASH_BYTES identifies a
+    # photo without reading all of it, and survives copies and renames
+    if file_size is None:
+        file_size = os.path.getsize(image_path)
+    digest = hashlib.blake2b(str(file_size).encode(), digest_size=20)
+    with open(image_path, "rb") as f:
+        digest.update(f.read(CACHE_HASH_BYTES))
+        if file_size > 2 * CACHE_HASH_BYTES:
+            f.seek(-CACHE_HASH_BYTES, os.SEEK_END)
+            digest.update(f.read(CACHE_HASH_BYTES))
+    return digest.hexdigest()
+
+
+class MetadataCache:
+    # SQLite store of raw and formatted metadata keyed by compute_file_key(),
+    # prefixed with the format version and the backend that read it
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        # Used from the metadata stage thread of the pipeline, one thread at
+        # a time
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "key TEXT PRIMARY KEY, formatted TEXT, raw TEXT, last_used REAL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_many(self, keys):
+        # Returns {key: (formatted_metadata, raw_metadata)} for the cached keys
+        keys = list(set(keys))
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self._connection.execute(
+                "SELECT key, formatted, raw FROM metadata WHERE key IN (%s)"
+                % ",".join("?" * len(chunk)),
+                chunk,
             )
-            write_metadata(directory_metadata, directory_metadata_path)
-    if has_errors:
-        logging.error(
-            f"Processing completed with errors. Please check: {error_directory}"
+            for key, formatted, raw in rows:
+                found[key] = (json.loads(formatted), json.loads(raw))
+
+        now = time.time()
+        self._connection.executemany(
+            "UPDATE metadata SET last_used = ? WHERE key = ?",
+            [(now, key) for key in found],
         )
+        self._connection.commit()
+        return found
 
-    # Testing only
-    input("Press Enter to close this window...")
+    def put_many(self, entries):
+        # entries: {key: (formatted_metadata, raw_metadata)}
+        now = time.time()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+            [
+                (key, json.dumps(formatted), json.dumps(raw), now)
+                for key, (formatted, raw) in entries.items()
+            ],
+        )
+        self._connection.commit()
+        # Once per batch, so a long watch run does not grow the database
+        if entries:
+            self.evict()
+
+    def evict(self):
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM metadata").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM metadata WHERE key IN "
+                "(SELECT key FROM metadata ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            self._connection.commit()
+            logging.info(f"Evicted {count - self.max_entries} metadata cache entries")
+
+    def close(self):
+        if self._connection is None:
+            return
+        try:
+            self.evict()
+        finally:
+            self._connection.close()
+            self._connection = None
 
 
-if __name__ == "__main__":
-    main()
+def extract_with_cache(backend, image_paths, cache=None, result=None, file_sizes=None):
+    # Cache hits skip the metadata backend entirely. file_sizes saves a stat
+    # per file when the sizes are already known from the directory scan.
+    if cache is None:
+        return backend.extract(image_paths)
+
+    file_sizes = file_sizes or {}
+    prefix = f"v{CACHE_FORMAT_VERSION}/{backend.cache_tag}/"
+    keys = {}
+    for image_path in image_paths:
+        try:
+            keys[image_path] = prefix + compute_file_key(
+                image_path, file_sizes.get(image_path)
+            )
+        except OSError as e:
+            logging.warning(f"Could not hash {image_path}: {e}")
+
+    cached = cache.get_many(keys.values())
+    misses = [path for path in image_paths if keys.get(path) not in cached]
+    batch_metadata = backend.extract(misses) if misses else {}
+    cache.put_many(
+        {
+            keys[path]: batch_metadata[path]
+            for path in misses
+            if path in keys
+            and path in batch_metadata
+            and path not in backend.partial_paths
+        }
+    )
+
+    for image_path, key in keys.items():
+        if key in cached and image_path not in batch_metadata:
+            formatted_metadata, raw_metadata = cached[key]
+            raw_metadata["SourceFile"] = image_path
+            batch_metadata[image_path] = (formatted_metadata, raw_metadata)
+
+    if result is not None:
+        result.cache_hits += len(image_paths) - len(misses)
+        result.cache_misses += len(misses)
+    return batch_metadata
+
+
+def compute_fingerprint(image_path, orientation=1):
+    # Hash of the whole file for exact copies, plus a 64-bit difference hash
+    # of the upright image for copies that were re-encoded or resized. The
+    # difference hash only needs a tiny decode, so JPEG and HEIC files are
+    # read at reduced size.
+    from PIL import Image
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    img = open_image_without_orientation(
+        image_path, FINGERPRINT_DECODE_SIZE, orientation
+    )
+    pixels = list(img.convert("L").resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    perceptual_hash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            perceptual_hash = (perceptual_hash << 1) | (
+                left > pixels[row * 9 + column + 1]
+            )
+    return digest.hexdigest(), perceptual_hash
+
+
+class DuplicateMatch:
+    def __init__(self, content_hash, group, source_path, kind, distance=0):
+        self.content_hash = content_hash  # Of the image this one duplicates
+        self.group = group
+        self.source_path = source_path
+        self.kind = kind  # exact or near
+        self.distance = distance
+
+
+class FingerprintIndex:
+    # SQLite store of compute_fingerprint() results of every image seen, kept
+    # across runs so copies of earlier uploads are found too. Near duplicates
+    # are looked up by splitting the perceptual hash into max_distance + 1
+    # bands: two hashes that differ in at most max_distance bits share at
+    # least one band exactly.
+
+    def __init__(self, path, max_distance=DUPLICATE_HASH_DISTANCE):
+        self.path = path
+        self.max_distance = max_distance
+        # Used from the metadata and write stages of the pipeline
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "content_hash TEXT PRIMARY KEY, perceptual_hash TEXT, "
+            "duplicate_group TEXT, source_path TEXT, output_path TEXT, added REAL)"
+        )
+
+        band_count = max_distance + 1 if max_distance > 0 else 0
+        width = 64 // band_count if band_count else 64
+        self._bands = [
+            (64 - width * (index + 1), (1 << width) - 1) for index in range(band_count)
+        ]
+        self._band_maps = [{} for _ in self._bands]
+        self._entries = {}  # content hash -> (perceptual hash, group, source path)
+        self._outputs = {}  # content hash -> stamped image
+        for (
+            content_hash,
+            perceptual_hash,
+            group,
+            source_path,
+            output_path,
+        ) in self._connection.execute(
+            "SELECT content_hash, perceptual_hash, duplicate_group, "
+            "source_path, output_path FROM fingerprints"
+        ):
+            self._remember(content_hash, int(perceptual_hash, 16), group, source_path)
+            if output_path:
+                self._outputs[content_hash] = output_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _remember(self, content_hash, perceptual_hash, group, source_path):
+        self._entries[content_hash] = (perceptual_hash, group, source_path)
+        for (shift, mask), band_map in zip(self._bands, self._band_maps):
+            band_map.setdefault((perceptual_hash >> shift) & mask, []).append(
+                content_hash
+            )
+
+    def _nearest(self, perceptual_hash):
+        best = None
+        for (shift, mask), band_map in zip(self._bands, self._band_maps):
+            for content_hash in band_map.get((perceptual_hash >> shift) & mask, ()):
+                distance = bin(perceptual_hash ^ self._entries[content_hash][0]).count(
+                    "1"
+                )
+                if distance <= self.max_distance and (
+                    best is None or distance < best[0]
+                ):
+                    best = (distance, content_hash)
+        return best
+
+    def check(self, source_path, content_hash, perceptual_hash, resumed=False):
+        # Returns (group, DuplicateMatch or None). Files not seen before are
+        # added as the first of a new group. resumed is set for a file this
+        # run already fingerprinted before it was interrupted, which is not a
+        # copy of itself when it was the one added.
+        with self._lock:
+            known = self._entries.get(content_hash)
+            if known is not None:
+                if resumed and known[2] == source_path:
+                    return known[1], None
+                return known[1], DuplicateMatch(
+                    content_hash, known[1], known[2], "exact"
+                )
+
+            # Flat images such as blank walls all hash alike, so they only
+            # match exact copies
+            nearest = None
+            if (
+                self._bands
+                and bin(perceptual_hash).count("1") >= FINGERPRINT_MIN_DETAIL
+            ):
+                nearest = self._nearest(perceptual_hash)
+            match = None
+            if nearest is not None:
+                distance, near_hash = nearest
+                near_group, near_source = self._entries[near_hash][1:]
+                match = DuplicateMatch(
+                    near_hash, near_group, near_source, "near", distance
+                )
+
+            # Near duplicates join the group; exact copies need no entry of their own
+            group = match.group if match else content_hash[:16]
+            self._remember(content_hash, perceptual_hash, group, source_path)
+            self._connection.execute(
+                "INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?, ?, NULL, ?)",
+                (
+                    content_hash,
+                    format(perceptual_hash, "016x"),
+                    group,
+                    source_path,
+                    time.time(),
+                ),
+            )
+            self._connection.commit()
+            return group, match
+
+    def output_path(self, content_hash):
+        with self._lock:
+            return self._outputs.get(content_hash)
+
+    def set_output(self, content_hash, output_path):
+        # Only the first image rendered with this content is linked to
+        with self._lock:
+            if content_hash not in self._entries or content_hash in self._outputs:
+                return
+            self._outputs[content_hash] = output_path
+            self._connection.execute(
+                "UPDATE fingerprints SET output_path = ? WHERE content_hash = ?",
+                (output_path, content_hash),
+            )
+            self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def write_raw_metadata(raw_metadata, output_path):
+    if WRITE_RAW_METADATA:
+        with open(output_path, "w") as f:
+            for key, value in raw_metadata.items():
+                f.write(f"{key}: {value}\n")
+
+
+class ReportWriter:
+    # Streams one row per processed file into the metadata report
+    appendable = False  # Whether rows can be added to an existing report
+
+    def __init__(self, output_path, append=False):
+        self.output_path = output_path
+        self.append = append
+        self.rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, file_info):
+        self._write(file_info)
+        self.rows_written += 1
+
+    def _write(self, file_info):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _continues_existing_file(self):
+        return (
+            self.append
+            and os.path.exists(self.output_path)
+            and os.path.getsize(self.output_path) > 0
+        )
+
+
+class TxtReportWriter(ReportWriter):
+    appendable = True
+
+    def __init__(self, output_path, append=False):
+        super().__init__(output_path, append)
+        continues = self._continues_existing_file()
+        self._file = open(output_path, "a" if append else "w")
+        if not continues:
+            self._file.write(METADATA_HEADER)
+            self._file.write(f"Filename: {os.path.basename(output_path)}\n")
+            self._file.write("\n")
+
+    def _write(self, file_info):
+        f = self._file
+        f.write(f"Filename: {file_info['filename']}\n")
+        f.write(f"File Size: {format_filesize_kb(file_info['file_size'])}\n")
+        f.write(f"File Type: {file_info['file_type']}\n")
+        f.write(f"File Path: {file_info['file_path']}\n")
+        # Write metadata values if present
+        f.write(f"Make: {file_info['metadata'].get('Make')}\n")
+        f.write(f"Model: {file_info['metadata'].get('Model')}\n")
+        lat_ref = file_info["metadata"].get("GPS GPSLatitudeRef") or "N"
+        latitude = convert_gps_to_dms(
+            file_info["metadata"].get("GPS Latitude"), lat_ref
+        )
+        f.write(f"Latitude: {latitude}\n")
+        lon_ref = file_info["metadata"].get("GPS GPSLongitudeRef") or "E"
+        longitude = convert_gps_to_dms(
+            file_info["metadata"].get("GPS Longitude"), lon_ref
+        )
+        f.write(f"Longitude: {longitude}\n")
+        f.write(f"Origin Date: {file_info['metadata'].get('Origin Date')}\n")
+        f.write(f"Orientation: {file_info['metadata'].get('Orientation')}\n")
+        f.write(f"Image Width: {file_info['metadata'].get('Image Width')}\n")
+        f.write(f"Image Height: {file_info['metadata'].get('Image Height')}\n")
+        f.write(f"Offset Time: {file_info['metadata'].get('Offset Time')}\n")
+        f.write(f"Megapixels: {file_info['metadata'].get('Megapixels')}\n")
+        if file_info.get("duplicate_of"):
+            f.write(f"Duplicate Of: {file_info['duplicate_of']}\n")
+        f.write("\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def build_xlsx_row(file_info):
+    metadata = file_info["metadata"]
+    row = [None] * (len(XLSX_COLUMNS) + len(XLSX_DUPLICATE_COLUMNS))
+
+    row[0] = file_info["filename"]
+    row[1] = file_info["file_path"]
+
+    # Convert 'Origin Date'
+    origin_date = metadata.get("Origin Date")
+    if origin_date:
+        row[2] = parse_image_date(origin_date)
+
+    # Convert 'Offset Time'
+    offset_time = metadata.get("Offset Time")
+    row[3] = offset_time if isinstance(offset_time, str) else str(offset_time)
+    row[4] = str(metadata.get("Orientation"))
+
+    # Handle potential None or invalid characters
+    make = metadata.get("Make")
+    if make:
+        row[5] = make.encode("ascii", errors="ignore").decode()
+    model = metadata.get("Model")
+    if model:
+        row[6] = model.encode("ascii", errors="ignore").decode()
+
+    row[7] = format_filesize_kb(file_info["file_size"])
+    row[8] = file_info["file_type"]
+    row[9] = str(metadata.get("GPS Latitude"))
+    row[10] = str(metadata.get("GPS Longitude"))
+    image_width = metadata.get("Image Width")
+    if image_width:
+        row[11] = int(str(image_width))
+    image_height = metadata.get("Image Height")
+    if image_height:
+        row[12] = int(str(image_height))
+    megapixels = metadata.get("Megapixels")
+    if megapixels:
+        row[13] = float(str(megapixels))
+    row[14] = file_info.get("duplicate_group")
+    row[15] = file_info.get("duplicate_of")
+
+    return row
+
+
+class XlsxReportWriter(ReportWriter):
+    # openpyxl's write-only mode needs the column widths before the first row,
+    # so rows are spooled to a temporary file while the widths are tracked and
+    # the workbook is streamed out and saved once on close
+
+    def __init__(self, output_path, append=False):
+        super().__init__(output_path, append)
+        self._spool = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        self._widths = [len(column) for column in XLSX_COLUMNS + XLSX_DUPLICATE_COLUMNS]
+        self._duplicates = False  # Rows carry a duplicate group
+
+    def _write(self, file_info):
+        self._duplicates = self._duplicates or "duplicate_group" in file_info
+        row = build_xlsx_row(file_info)
+        for index, value in enumerate(row):
+            if value is not None:
+                self._widths[index] = max(self._widths[index], len(str(value)))
+        self._spool.write(json.dumps(row) + "\n")
+
+    def close(self):
+        if self._spool.closed:
+            return
+
+        import openpyxl
+
+        columns = XLSX_COLUMNS
+        if self._duplicates:
+            columns += XLSX_DUPLICATE_COLUMNS
+        try:
+            wb = openpyxl.Workbook(write_only=True)
+            sheet = wb.create_sheet()
+            for index, width in enumerate(self._widths[: len(columns)], start=1):
+                column_letter = openpyxl.utils.get_column_letter(index)
+                sheet.column_dimensions[column_letter].width = width
+
+            sheet.append(columns)
+            self._spool.seek(0)
+            for line in self._spool:
+                sheet.append(json.loads(line)[: len(columns)])
+            wb.save(self.output_path)
+        finally:
+            self._spool.close()
+
+
+# ExifTool prints 39 deg 5' 30.50" N, or just 39.0918 with -n
+GPS_VALUE_PATTERN = re.compile(
+    r"\s*([+-]?\d+(?:\.\d+)?)"
+    r"(?:\s*deg(?:\s*(\d+(?:\.\d+)?)')?(?:\s*(\d+(?:\.\d+)?)\")?)?"
+    r"\s*([NSEW])?\s*$",
+    re.IGNORECASE,
+)
+
+
+def parse_gps_parts(value, reference=None):
+    # Returns (degrees, minutes, seconds, hemisphere letter) or None
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value), 0.0, 0.0, str(reference or "")[:1].upper()
+    match = GPS_VALUE_PATTERN.match(str(value))
+    if not match:
+        return None
+    degrees, minutes, seconds, hemisphere = match.groups()
+    # The letter in the text wins over the separate reference tag
+    hemisphere = (hemisphere or str(reference or "")[:1]).upper()
+    return float(degrees), float(minutes or 0), float(seconds or 0), hemisphere
+
+
+def parse_gps_decimal(value, reference=None):
+    # One coordinate as signed decimal degrees, see normalize_gps() for many
+    parts = parse_gps_parts(value, reference)
+    if parts is None:
+        return None
+    degrees, minutes, seconds, hemisphere = parts
+    decimal = abs(degrees) + minutes / 60 + seconds / 3600
+    if hemisphere in ("S", "W") or (degrees < 0 and hemisphere not in ("N", "E")):
+        decimal = -decimal
+    return round(decimal, 7)
+
+
+def normalize_gps(file_infos):
+    # The GPS stage of a report: parses the coordinates of all files in one
+    # pass and returns signed decimal-degree latitude and longitude arrays,
+    # NaN where a file has no usable position. Needs numpy.
+    import numpy
+
+    count = len(file_infos)
+    parts = numpy.full((2 * count, 3), numpy.nan)
+    hemispheres = numpy.zeros(2 * count, dtype="U1")
+    for index, file_info in enumerate(file_infos):
+        metadata = file_info["metadata"]
+        for offset, key in ((0, "GPS Latitude"), (count, "GPS Longitude")):
+            parsed = parse_gps_parts(
+                metadata.get(key), metadata.get(f"GPS GPS{key[4:]}Ref")
+            )
+            if parsed is not None:
+                parts[index + offset] = parsed[:3]
+                hemispheres[index + offset] = parsed[3]
+
+    decimal = numpy.abs(parts[:, 0]) + parts[:, 1] / 60 + parts[:, 2] / 3600
+    negative = numpy.isin(hemispheres, ("S", "W")) | (
+        (parts[:, 0] < 0) & ~numpy.isin(hemispheres, ("N", "E"))
+    )
+    decimal = numpy.round(numpy.where(negative, -decimal, decimal), 7)
+
+    latitudes, longitudes = decimal[:count], decimal[count:]
+    latitudes[numpy.abs(latitudes) > 90] = numpy.nan
+    longitudes[numpy.abs(longitudes) > 180] = numpy.nan
+    # A position needs both halves
+    missing = numpy.isnan(latitudes) | numpy.isnan(longitudes)
+    latitudes[missing] = numpy.nan
+    longitudes[missing] = numpy.nan
+    return latitudes, longitudes
+
+
+def to_iso_timestamp(origin_date, offset_time=None):
+    # 2024-05-01 10:11:12 and -05:00 become 2024-05-01T10:11:12-05:00
+    if not origin_date:
+        return None
+    try:
+        timestamp = datetime.strptime(
+            parse_image_date(str(origin_date)), "%Y-%m-%d %H:%M:%S"
+        )
+    except ValueError:
+        return None
+
+    iso_timestamp = timestamp.isoformat()
+    if offset_time and re.fullmatch(r"[+-]\d{2}:\d{2}", str(offset_time)):
+        iso_timestamp += str(offset_time)
+    return iso_timestamp
+
+
+def to_number(value, number_type):
+    if value is None or value == "":
+        return None
+    try:
+        return number_type(str(value))
+    except ValueError:
+        return None
+
+
+def build_report_record(file_info):
+    metadata = file_info["metadata"]
+    # Filled in by the GPS stage when the whole report is written at once
+    if "latitude" in file_info:
+        latitude, longitude = file_info["latitude"], file_info["longitude"]
+    else:
+        latitude = parse_gps_decimal(
+            metadata.get("GPS Latitude"), metadata.get("GPS GPSLatitudeRef")
+        )
+        longitude = parse_gps_decimal(
+            metadata.get("GPS Longitude"), metadata.get("GPS GPSLongitudeRef")
+        )
+    return {
+        "filename": file_info["filename"],
+        "file_path": file_info["file_path"],
+        "file_type": file_info["file_type"],
+        "file_size": file_info["file_size"],
+        "origin_date": to_iso_timestamp(
+            metadata.get("Origin Date"), metadata.get("Offset Time")
+        ),
+        "offset_time": metadata.get("Offset Time") or None,
+        "orientation": metadata.get("Orientation") or None,
+        "make": metadata.get("Make") or None,
+        "model": metadata.get("Model") or None,
+        "latitude": latitude,
+        "longitude": longitude,
+        "image_width": to_number(metadata.get("Image Width"), int),
+        "image_height": to_number(metadata.get("Image Height"), int),
+        "megapixels": to_number(metadata.get("Megapixels"), float),
+        "duplicate_group": file_info.get("duplicate_group"),
+        "duplicate_of": file_info.get("duplicate_of"),
+    }
+
+
+class CsvReportWriter(ReportWriter):
+    appendable = True
+
+    def __init__(self, output_path, append=False):
+        super().__init__(output_path, append)
+        continues = self._continues_existing_file()
+        self._file = open(
+            output_path, "a" if append else "w", newline="", encoding="utf-8"
+        )
+        self._writer = csv.DictWriter(self._file, fieldnames=REPORT_FIELDS)
+        if not continues:
+            self._writer.writeheader()
+
+    def _write(self, file_info):
+        self._writer.writerow(build_report_record(file_info))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class JsonlReportWriter(ReportWriter):
+    appendable = True
+
+    def __init__(self, output_path, append=False):
+        super().__init__(output_path, append)
+        self._file = open(output_path, "a" if append else "w", encoding="utf-8")
+
+    def _write(self, file_info):
+        self._file.write(json.dumps(build_report_record(file_info)) + "\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class ParquetReportWriter(ReportWriter):
+    # Rows are buffered and flushed as row groups, so memory stays bounded
+
+    def __init__(self, output_path, append=False, batch_size=PARQUET_BATCH_SIZE):
+        super().__init__(output_path, append)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet reports need pyarrow (pip install pyarrow)")
+
+        self._pyarrow = pyarrow
+        types = {
+            "file_size": pyarrow.int64(),
+            "latitude": pyarrow.float64(),
+            "longitude": pyarrow.float64(),
+            "image_width": pyarrow.int64(),
+            "image_height": pyarrow.int64(),
+            "megapixels": pyarrow.float64(),
+        }
+        self._schema = pyarrow.schema(
+            [(field, types.get(field, pyarrow.string())) for field in REPORT_FIELDS]
+        )
+        self._writer = pyarrow.parquet.ParquetWriter(output_path, self._schema)
+        self._batch_size = batch_size
+        self._rows = []
+
+    def _write(self, file_info):
+        self._rows.append(build_report_record(file_info))
+        if len(self._rows) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            table = self._pyarrow.Table.from_pylist(self._rows, schema=self._schema)
+            self._writer.write_table(table)
+            self._rows = []
+
+    def close(self):
+        if self._writer is None:
+            return
+        try:
+            self._flush()
+        finally:
+            self._writer.close()
+            self._writer = None
+
+
+REPORT_WRITERS = {
+    "txt": TxtReportWriter,
+    "xlsx": XlsxReportWriter,
+    "csv": CsvReportWriter,
+    "jsonl": JsonlReportWriter,
+    "parquet": ParquetReportWriter,
+}
+
+
+def open_report_writer(output_path, metadata_format=None, append=False):
+    metadata_format = metadata_format or METADATA_FORMAT
+    if metadata_format not in REPORT_WRITERS:
+        raise ValueError("Unsupported format")
+
+    writer_class = REPORT_WRITERS[metadata_format]
+    if append and not writer_class.appendable:
+        raise ValueError(f"{metadata_format} reports cannot be appended to")
+    return writer_class(output_path, append=append)
+
+
+def add_report_positions(file_infos):
+    # Runs the GPS stage over all report rows at once and stores the decimal
+    # degrees in each row. Returns the arrays for the spatial index, or None
+    # without numpy, in which case each row is parsed as it is written.
+    try:
+        latitudes, longitudes = normalize_gps(file_infos)
+    except ImportError:
+        logging.warning("numpy is not installed, no spatial index is written")
+        return None
+
+    for file_info, latitude, longitude in zip(
+        file_infos, latitudes.tolist(), longitudes.tolist()
+    ):
+        located = latitude == latitude  # NaN is not equal to itself
+        file_info["latitude"] = latitude if located else None
+        file_info["longitude"] = longitude if located else None
+    return latitudes, longitudes
+
+
+def grid_cells(latitudes, longitudes, cell_degrees=SPATIAL_CELL_DEGREES):
+    # One int64 key per grid cell, ordered by row and then by column, so the
+    # cells of one row of a search box form a single key range
+    import numpy
+
+    rows = numpy.floor((latitudes + 90) / cell_degrees).astype(numpy.int64)
+    columns = numpy.floor((longitudes + 180) / cell_degrees).astype(numpy.int64)
+    return rows * (int(360 / cell_degrees) + 1) + columns
+
+
+def haversine_metres(latitude, longitude, latitudes, longitudes):
+    import numpy
+
+    latitude, longitude = numpy.radians(latitude), numpy.radians(longitude)
+    latitudes, longitudes = numpy.radians(latitudes), numpy.radians(longitudes)
+    a = (
+        numpy.sin((latitudes - latitude) / 2) ** 2
+        + numpy.cos(latitude)
+        * numpy.cos(latitudes)
+        * numpy.sin((longitudes - longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_METRES * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def write_spatial_index(path, file_infos, latitudes, longitudes):
+    # Files with a position, sorted by grid cell, as a numpy .npz next to the
+    # report. Written under a temporary name like the stamped images.
+    import numpy
+
+    located = numpy.flatnonzero(~numpy.isnan(latitudes))
+    cells = grid_cells(latitudes[located], longitudes[located])
+    order = numpy.argsort(cells, kind="stable")
+    located = located[order]
+    partial_path = path + PARTIAL_SUFFIX
+    with open(partial_path, "wb") as f:
+        numpy.savez(
+            f,
+            cell_degrees=numpy.float64(SPATIAL_CELL_DEGREES),
+            cells=cells[order],
+            latitude=latitudes[located],
+            longitude=longitudes[located],
+            row=located,
+            file_path=numpy.array(
+                [file_infos[index]["file_path"] for index in located], dtype=str
+            ),
+        )
+    os.replace(partial_path, path)
+    return len(located)
+
+
+class SpatialIndex:
+    # Reads the _gps.npz files written next to the reports and answers "which
+    # photos were taken within N metres of here" by binary search over the
+    # grid cells around the point, without reading the reports themselves
+
+    def __init__(self, path):
+        import numpy
+
+        self.path = path
+        with numpy.load(path) as data:
+            self.cell_degrees = float(data["cell_degrees"])
+            self.cells = data["cells"]
+            self.latitudes = data["latitude"]
+            self.longitudes = data["longitude"]
+            self.rows = data["row"]
+            self.file_paths = data["file_path"]
+
+    def __len__(self):
+        return len(self.cells)
+
+    def within(self, latitude, longitude, radius_metres):
+        # Yields (distance in metres, row of the report, file path, latitude,
+        # longitude), nearest first
+        import numpy
+
+        latitude_span = numpy.degrees(radius_metres / EARTH_RADIUS_METRES)
+        cos_latitude = max(numpy.cos(numpy.radians(latitude)), 1e-6)
+        longitude_span = min(180.0, latitude_span / cos_latitude)
+
+        south = max(-90.0, latitude - latitude_span)
+        north = min(90.0, latitude + latitude_span)
+        columns_per_row = int(360 / self.cell_degrees) + 1
+        first_row, last_row = (
+            int(numpy.floor((value + 90) / self.cell_degrees))
+            for value in (south, north)
+        )
+        west, east = longitude - longitude_span, longitude + longitude_span
+        # Boxes across the antimeridian are searched as two ranges
+        if longitude_span >= 180:
+            longitude_ranges = [(-180.0, 180.0)]
+        elif west < -180:
+            longitude_ranges = [(west + 360, 180.0), (-180.0, east)]
+        elif east > 180:
+            longitude_ranges = [(west, 180.0), (-180.0, east - 360)]
+        else:
+            longitude_ranges = [(west, east)]
+
+        candidates = []
+        for grid_row in range(first_row, last_row + 1):
+            for low, high in longitude_ranges:
+                first_column = int(numpy.floor((low + 180) / self.cell_degrees))
+                last_column = int(numpy.floor((high + 180) / self.cell_degrees))
+                start, stop = numpy.searchsorted(
+                    self.cells,
+                    [
+                        grid_row * columns_per_row + first_column,
+                        grid_row * columns_per_row + last_column + 1,
+                    ],
+                )
+                if stop > start:
+                    candidates.append(numpy.arange(start, stop))
+        if not candidates:
+            return
+
+        candidates = numpy.concatenate(candidates)
+        distances = haversine_metres(
+            latitude, longitude, self.latitudes[candidates], self.longitudes[candidates]
+        )
+        inside = distances <= radius_metres
+        candidates, distances = candidates[inside], distances[inside]
+        for position in numpy.argsort(distances, kind="stable"):
+            index = candidates[position]
+            yield (
+                float(distances[position]),
+                int(self.rows[index]),
+                str(self.file_paths[index]),
+                float(self.latitudes[index]),
+                float(self.longitudes[index]),
+            )
+
+
+def get_spatial_index_path(report_path):
+    return os.path.splitext(report_path)[0] + SPATIAL_INDEX_SUFFIX
+
+
+def write_metadata(metadata, output_path, metadata_format=None):
+    with open_report_writer(output_path, metadata_format) as writer:
+        for file_info in metadata["files"]:
+            writer.write(file_info)
+
+
+def open_image(fp):
+    # Image.open with our pixel limit, applied when Pillow is first loaded
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    return Image.open(fp)
+
+
+def fit_size(size, max_dimension):
+    scale = max_dimension / max(size)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def read_orientation(img, image_path):
+    try:
+        return img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    except (AttributeError, OSError, SyntaxError, ValueError):
+        print(f"Image file might be corrupt or missing EXIF data: {image_path}")
+        return 1
+
+
+def open_heic_image(image_path, max_dimension=None):
+    # Decodes the primary image with libheif directly, or the smallest
+    # embedded thumbnail that still covers max_dimension
+    import pillow_heif
+
+    register_heif_opener()
+    heif_file = pillow_heif.open_heif(image_path)
+    heif_image = heif_file[heif_file.primary_index]
+
+    if max_dimension and max(heif_image.size) > max_dimension:
+        thumbnails = sorted(
+            (size, index)
+            for index, size in enumerate(heif_image.info.get("thumbnails", []))
+            if isinstance(size, int) and size >= max_dimension
+        )
+        if thumbnails and hasattr(heif_image, "get_thumbnail"):
+            img = heif_image.get_thumbnail(thumbnails[0][1]).to_pillow()
+            # EXIF and the color profile belong to the primary image
+            img.info = dict(heif_image.info, **img.info)
+            return img
+
+    return heif_image.to_pillow()
+
+
+def open_image_without_orientation(
+    image_path, max_dimension=None, orientation=None, timings=None
+):
+    # Returns the image upright, in a mode the label can be pasted onto and
+    # scaled down to max_dimension. Each step replaces the image before it and
+    # turning it upright comes last, on the reduced image. orientation is the
+    # EXIF value when the metadata extractor has already read it. The decode
+    # and orientation times are added to the timings dict when one is given.
+    from PIL import Image
+
+    decode_start = time.perf_counter()
+    if is_heic_file(image_path):
+        img = open_heic_image(image_path, max_dimension)
+        orientation = 1  # libheif turns HEIC images upright while decoding
+    else:
+        img = open_image(image_path)
+        if orientation is None:
+            orientation = read_orientation(img, image_path)
+
+    # JPEG files are decoded at 1/2, 1/4 or 1/8 scale and HEIF files from an
+    # embedded thumbnail when one is large enough, so the full-size image is
+    # never decoded. The rest is scaled down after decoding.
+    if max_dimension and max(img.size) > max_dimension:
+        img.draft(None, fit_size(img.size, max_dimension))
+    img = prepare_for_overlay(img)
+    if max_dimension and max(img.size) > max_dimension:
+        img = img.resize(fit_size(img.size, max_dimension), Image.LANCZOS)
+
+    orientation_start = time.perf_counter()
+    transpose = ORIENTATION_TRANSPOSES.get(orientation)
+    if transpose is not None:
+        img = img.transpose(Image.Transpose[transpose])
+
+    if timings is not None:
+        timings["decode"] = orientation_start - decode_start
+        timings["orientation"] = time.perf_counter() - orientation_start
+    return img
+
+
+def prepare_for_overlay(img):
+    # Keep the image in its own mode where a label can be pasted onto it
+    # directly, so a large photo is never copied into an RGBA frame
+    if img.mode in OVERLAY_NATIVE_MODES:
+        # Decode now: pasting onto a file image that is not loaded yet makes
+        # Pillow copy the whole frame first
+        img.load()
+        return img
+    if img.mode in ("PA", "RGBa", "La") or "transparency" in img.info:
+        return img.convert("RGBA")
+    return img.convert("RGB")
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_font_path(font_path):
+    # Checked once per path, returns None when only Pillow's own font is left
+    from PIL import ImageFont
+
+    for path in (font_path,) + FALLBACK_FONT_PATHS:
+        try:
+            ImageFont.truetype(path, 12)
+        except OSError:
+            continue
+        if path != font_path:
+            logging.warning(f"Font {font_path} not found, using {path}")
+        return path
+
+    logging.warning(f"Font {font_path} not found, using the font bundled with Pillow")
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def load_font(font_path, size):
+    # Most photos in a batch share a resolution, so only a few sizes are loaded
+    from PIL import ImageFont
+
+    path = resolve_font_path(font_path)
+    if path is None:
+        return ImageFont.load_default(size)
+    return ImageFont.truetype(path, size)
+
+
+@functools.lru_cache(maxsize=256)
+def measure_line(line, font_path, size):
+    # Box of one line of the label drawn at (0, 0). The header and lines such
+    # as the camera make and model repeat from image to image, so most lines
+    # are only measured for the first image of each size.
+    from PIL import Image, ImageDraw
+
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    return draw.textbbox((0, 0), line, font=load_font(font_path, size))
+
+
+def line_spacing(font_path, size):
+    # Distance between the lines of multiline text, as Pillow spaces them
+    return measure_line("A", font_path, size)[3] + LABEL_LINE_SPACING
+
+
+def measure_text(text, font_path, size):
+    # Right and bottom edge of the label text drawn at (0, 0): the union of
+    # its lines, the way Pillow measures multiline text. Only the label
+    # itself is ever allocated.
+    spacing = line_spacing(font_path, size)
+    right = bottom = 0
+    for index, line in enumerate(text.split("\n")):
+        _, _, line_right, line_bottom = measure_line(line, font_path, size)
+        right = max(right, line_right)
+        bottom = max(bottom, line_bottom + index * spacing)
+    return right, bottom
+
+
+@functools.lru_cache(maxsize=16)
+def render_line_mask(line, font_path, size):
+    # Coverage of one line of text, drawn once and pasted in the text color.
+    # Used for the header, the same on every label of a given size.
+    from PIL import Image, ImageDraw
+
+    _, _, right, bottom = measure_line(line, font_path, size)
+    mask = Image.new("L", (max(1, right), max(1, bottom)), 0)
+    ImageDraw.Draw(mask).text((0, 0), line, fill=255, font=load_font(font_path, size))
+    return mask
+
+
+def render_label(text, font_path, size, padding, color, background_color):
+    # Label-sized tile holding the semi-transparent box and the text, about
+    # 15 MB at 48 MP. The tile itself is not cached, the text includes the
+    # file name; only the header line is reused across images.
+    from PIL import Image, ImageDraw
+
+    padding_left, padding_right, padding_top, padding_bottom = padding
+    text_width, text_height = measure_text(text, font_path, size)
+    label = Image.new(
+        "RGBA",
+        (
+            padding_left + text_width + padding_right,
+            padding_top + text_height + padding_bottom,
+        ),
+        (255, 255, 255, 0),
+    )
+    label_draw = ImageDraw.Draw(label)
+    label_draw.rectangle(((0, 0), label.size), fill=background_color)
+    header, _, body = text.partition("\n")
+    label.paste(
+        color, (padding_left, padding_top), render_line_mask(header, font_path, size)
+    )
+    label_draw.text(
+        (padding_left, padding_top + line_spacing(font_path, size)),
+        body,
+        fill=color,
+        font=load_font(font_path, size),
+    )
+    return label
+
+
+def draw_overlay(
+    img,
+    text,
+    position,
+    overlay_position="top-left",
+    color=(0, 0, 0),
+    background_color=(255, 255, 255, 128),
+    font_path=FONT_PATH,
+):
+    # Font size and padding follow the size of the image as it is stamped,
+    # so a reduced preview gets a proportionally smaller label
+    width, height = img.size
+
+    # Dynamic Font Scaling
+    font_size = max(
+        12, int(height * 0.02)
+    )  # Base size of 12, scales with 2% of image height
+
+    # Dynamic Padding
+    padding_left = int(min(width, height) * PADDING_LEFT_FACTOR)
+    padding_right = int(padding_left * PADDING_RIGHT_FACTOR)
+    padding_top = int(height * PADDING_TOP_FACTOR)
+    padding_bottom = int(height * PADDING_BOTTOM_FACTOR)
+
+    if not text:
+        text = NO_METADATA_MESSAGE
+
+    text = METADATA_HEADER + text
+
+    text_width, text_height = measure_text(text, font_path, font_size)
+
+    if overlay_position == "top-left":
+        text_position = (position[0], position[1])
+    elif overlay_position == "top-right":
+        text_position = (width - text_width - padding_right, position[1])
+    elif overlay_position == "bottom-left":
+        text_position = (position[0], height - text_height - padding_bottom)
+    elif overlay_position == "bottom-right":
+        text_position = (
+            width - text_width - padding_right,
+            height - text_height - padding_bottom,
+        )
+
+    label = render_label(
+        text,
+        font_path,
+        font_size,
+        (padding_left, padding_right, padding_top, padding_bottom),
+        tuple(color),
+        tuple(background_color),
+    )
+
+    # Blend the tile onto the region under it only, the rest of the image is
+    # left untouched
+    img.paste(
+        label,
+        (text_position[0] - padding_left, text_position[1] - padding_top),
+        mask=label,
+    )
+
+    return img
+
+
+def get_output_path(image_path, text, output_directory, extension=".png"):
+    date_match = re.search(r"Date/Time: (\d{4}-\d{2}-\d{2})", text)
+    if date_match:
+        date_str = date_match.group(1)  # Extract the date string
+        date_obj = datetime.strptime(date_str, "%Y-%m-%d")  # Convert to datetime object
+        date_folder = date_obj.strftime("%m-%d-%Y")
+    else:
+        date_folder = datetime.now().strftime(
+            "%m-%d-%Y"
+        )  # Fallback to current date if not found
+
+    date_folder_path = os.path.join(output_directory, date_folder)
+    os.makedirs(date_folder_path, exist_ok=True)
+
+    filename = os.path.basename(image_path)
+    new_name = os.path.splitext(filename)[0] + "_MD" + extension
+    return os.path.join(date_folder_path, new_name)
+
+
+def resolve_output_format(image_path, output_format):
+    if output_format == "source":
+        extension = os.path.splitext(image_path)[1].lower()
+        return SOURCE_OUTPUT_FORMATS.get(extension, "png")
+    return output_format
+
+
+def encode_image(
+    img,
+    path,
+    output_format,
+    quality=OUTPUT_QUALITY,
+    compress_level=PNG_COMPRESS_LEVEL,
+    exif=None,
+    icc_profile=None,
+):
+    pil_format = OUTPUT_ENCODERS[output_format][0]
+    if output_format == "png":
+        params = {"compress_level": compress_level}
+    else:
+        params = {"quality": quality}
+
+    if output_format == "jpeg" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")  # JPEG has no alpha channel
+
+    # Passed even when empty, otherwise Pillow copies the profile on its own
+    params["icc_profile"] = icc_profile
+    if exif:
+        params["exif"] = exif
+    img.save(path, format=pil_format, **params)
+
+
+def get_source_metadata(img, keep_exif, keep_icc_profile):
+    # EXIF and color profile of the source for the stamped copy
+    exif = None
+    if keep_exif:
+        exif = img.getexif()
+        if EXIF_ORIENTATION_TAG in exif:
+            # The pixels have already been turned upright
+            exif[EXIF_ORIENTATION_TAG] = 1
+        exif = exif.tobytes() if exif else None
+    icc_profile = img.info.get("icc_profile") if keep_icc_profile else None
+    return exif, icc_profile
+
+
+def check_and_clear_directory(directory, assume_yes=False):
+    if os.path.exists(directory):
+        # One listing both to check for contents and to clear them
+        with os.scandir(directory) as listing:
+            contents = list(listing)
+        if contents:
+            response = (
+                "y"
+                if assume_yes
+                else input(
+                    f"Directory {directory} is not empty. Delete all contents? (y/n, default y): "
+                )
+            )
+            if response.lower() != "n":
+                # Clear the directory
+                for entry in contents:
+                    file_path = entry.path
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(file_path)
+                        else:
+                            os.unlink(file_path)
+                        logging.info(f"All contents of {directory} have been deleted.")
+                    except PermissionError:
+                        logging.warning(
+                            f"Could not delete file {file_path} because it is being used by another process."
+                        )
+                        print(
+                            f"\nError: Could not delete {file_path}. Please ensure the file is closed and not being used by any other program.\n"
+                        )
+                        if not assume_yes:
+                            input("Press Enter to continue...")
+            else:
+                logging.error("Operation aborted by the user.")
+                return False
+    else:
+        os.makedirs(directory, exist_ok=True)
+    return True
+
+
+def build_overlay_text(filepath, formatted_metadata):
+    overlay_text_content = f"Filename: {os.path.basename(filepath)}\n"
+
+    if all(value is None for value in formatted_metadata.values()):
+        overlay_text_content += "No Metadata Available\n"
+        return overlay_text_content
+
+    image_width = None
+    for key, value in formatted_metadata.items():
+        if key == "GPS Latitude" and value:
+            lat_ref = formatted_metadata.get("GPS GPSLatitudeRef") or "N"
+            latitude = convert_gps_to_dms(value, lat_ref)
+            overlay_text_content += f"Latitude: {latitude}\n"
+        elif key == "GPS Longitude" and value:
+            lon_ref = formatted_metadata.get("GPS GPSLongitudeRef") or "E"
+            longitude = convert_gps_to_dms(value, lon_ref)
+            overlay_text_content += f"Longitude: {longitude}\n"
+        elif key == "Origin Date" and value:
+            overlay_text_content += f"Date/Time: {value}\n"
+        elif key == "Offset Time" and value:
+            overlay_text_content += f"Offset Time: {value}\n"
+        elif key == "Orientation" and value:
+            overlay_text_content += f"Orientation: {value}\n"
+        elif key == "Make" and value:
+            overlay_text_content += f"Make: {value}\n"
+        elif key == "Model" and value:
+            overlay_text_content += f"Model: {value}\n"
+        elif key == "Image Width" and value:
+            image_width = value
+        elif key == "Image Height" and value and image_width:
+            overlay_text_content += f"Image Size: {image_width} x {value}\n"
+            image_width = None
+        elif key == "Megapixel" and value:
+            overlay_text_content += f"Megapixel: {value}\n"
+
+    return overlay_text_content
+
+
+class RenderOptions:
+    # How images are stamped; passed to worker processes, so keep it picklable
+
+    def __init__(
+        self,
+        output_directory,
+        overlay_position="top-left",
+        font_path=None,
+        output_format=None,
+        output_quality=None,
+        png_compress_level=None,
+        keep_exif=None,
+        keep_icc_profile=None,
+        max_dimension=None,
+        heic_decode_threads=None,
+    ):
+        self.output_directory = output_directory
+        self.overlay_position = overlay_position
+        self.font_path = font_path or FONT_PATH
+        self.output_format = output_format or OUTPUT_FORMAT
+        self.output_quality = (
+            OUTPUT_QUALITY if output_quality is None else output_quality
+        )
+        self.png_compress_level = (
+            PNG_COMPRESS_LEVEL if png_compress_level is None else png_compress_level
+        )
+        self.keep_exif = KEEP_EXIF if keep_exif is None else keep_exif
+        self.keep_icc_profile = (
+            KEEP_ICC_PROFILE if keep_icc_profile is None else keep_icc_profile
+        )
+        self.max_dimension = max_dimension or MAX_DIMENSION
+        self.heic_decode_threads = heic_decode_threads or HEIC_DECODE_THREADS
+
+
+class RenderResult:
+    def __init__(
+        self,
+        source_path,
+        output_path,
+        partial_path,
+        output_format=None,
+        bytes_written=0,
+        timings=None,
+        render_seconds=0.0,
+    ):
+        self.source_path = source_path
+        self.output_path = output_path
+        self.partial_path = partial_path
+        self.output_format = output_format
+        self.bytes_written = bytes_written
+        self.timings = timings or {}  # stage -> seconds spent in the renderer
+        self.render_seconds = render_seconds  # Decode, overlay and encode
+
+    @property
+    def decode_seconds(self):
+        return self.timings.get("decode", 0.0) + self.timings.get("orientation", 0.0)
+
+    @property
+    def encode_seconds(self):
+        return self.timings.get("encode", 0.0)
+
+
+def render_image(filepath, text, options, orientation=None):
+    # Runs in the main process or in a worker. The stamped image is written
+    # next to its final name and only moved into place by commit_output(), so
+    # an interrupted run never leaves a truncated output behind
+    render_start = time.perf_counter()
+    if is_heic_file(filepath):
+        register_heif_opener(options.heic_decode_threads)
+
+    timings = {}
+    img = open_image_without_orientation(
+        filepath, options.max_dimension, orientation, timings
+    )
+    composite_start = time.perf_counter()
+    img = draw_overlay(
+        img, text, (10, 10), options.overlay_position, font_path=options.font_path
+    )
+    timings["composite"] = time.perf_counter() - composite_start
+    output_format = resolve_output_format(filepath, options.output_format)
+    output_path = get_output_path(
+        filepath, text, options.output_directory, OUTPUT_ENCODERS[output_format][1]
+    )
+    partial_path = output_path + PARTIAL_SUFFIX
+    exif, icc_profile = get_source_metadata(
+        img, options.keep_exif, options.keep_icc_profile
+    )
+
+    encode_start = time.perf_counter()
+    encode_image(
+        img,
+        partial_path,
+        output_format,
+        quality=options.output_quality,
+        compress_level=options.png_compress_level,
+        exif=exif,
+        icc_profile=icc_profile,
+    )
+    timings["encode"] = time.perf_counter() - encode_start
+
+    logging.info(f"Successfully processed Image file: {filepath}")
+    return RenderResult(
+        filepath,
+        output_path,
+        partial_path,
+        output_format=output_format,
+        bytes_written=os.path.getsize(partial_path),
+        timings=timings,
+        render_seconds=time.perf_counter() - render_start,
+    )
+
+
+def commit_output(render_result):
+    os.replace(render_result.partial_path, render_result.output_path)
+
+
+class ProcessingJournal:
+    # Append-only JSON lines log of how far each file got, kept in the output
+    # directory so an interrupted run can be resumed. Each line is flushed as
+    # it is written and synced to disk before a source file is removed.
+
+    EXTRACTED = "extracted"
+    RENDERED = "rendered"
+    SAVED = "saved"
+    SOURCE_REMOVED = "source_removed"
+    FAILED = "failed"
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # source path -> latest entry, in first-seen order
+        self.complete = False
+        self._lock = threading.Lock()  # Pipeline stages record from their threads
+
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # Torn write from a crash, nothing after it counts
+                    self._apply(entry)
+
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def interrupted(self):
+        return bool(self.files) and not self.complete
+
+    def _apply(self, entry):
+        if entry.get("event") == "complete":
+            self.complete = True
+            return
+        if entry.get("event") == "start":
+            self.complete = False
+            return
+
+        state = self.files.setdefault(entry["file"], {})
+        state.update(entry)
+
+    def _append(self, entry, sync=False):
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+            self._apply(entry)
+
+    def start(self):
+        self._append({"event": "start", "time": time.time()})
+
+    def record(self, source_path, state, sync=False, **fields):
+        self._append(dict(fields, file=source_path, state=state), sync=sync)
+
+    def state(self, source_path):
+        return self.files.get(source_path, {}).get("state")
+
+    def entry(self, source_path):
+        return self.files.get(source_path, {})
+
+    def report_rows(self):
+        # Every file whose metadata was read, in the order it was first seen
+        for entry in self.files.values():
+            if entry.get("file_info") and entry.get("state") != self.EXTRACTED:
+                yield entry["file_info"]
+
+    def finish(self):
+        self._append({"event": "complete", "time": time.time()}, sync=True)
+
+    def reset(self):
+        # Starts an empty journal once everything recorded so far is finished
+        self._file.close()
+        self.files = {}
+        self.complete = False
+        self._file = open(self.path, "w", encoding="utf-8")
+        self.start()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class FileClaims:
+    # Claim files that let several processes, possibly on different machines,
+    # share one input directory. A claim is created with O_EXCL, which is
+    # atomic on local disks and on NFS v3+ and SMB shares, so only one
+    # process ever works on an image. Claims of a process that stopped are
+    # taken over once they are stale, or right away by the same shard on the
+    # same host when it is run again.
+
+    def __init__(
+        self, directory, input_directory, owner, stale_seconds=CLAIM_STALE_SECONDS
+    ):
+        self.directory = directory
+        self.input_directory = input_directory
+        self.owner = owner
+        self.stale_seconds = stale_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, filepath):
+        relative_path = os.path.relpath(filepath, self.input_directory)
+        relative_path = relative_path.replace(os.sep, "/").encode("utf-8")
+        name = hashlib.blake2b(relative_path, digest_size=16).hexdigest()
+        return os.path.join(self.directory, name + ".claim")
+
+    def claim(self, filepath):
+        # Returns False when another process holds the image
+        claim_path = self._path(filepath)
+        for attempt in range(2):
+            try:
+                fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if attempt or not self._take_over(claim_path):
+                    return False
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(
+                    {"file": filepath, "owner": self.owner, "claimed": time.time()}, f
+                )
+            return True
+        return False
+
+    def _take_over(self, claim_path):
+        try:
+            modified = os.path.getmtime(claim_path)
+            with open(claim_path, encoding="utf-8") as f:
+                owner = json.load(f).get("owner")
+        except FileNotFoundError:
+            return True  # Released in the meantime
+        except (OSError, ValueError):
+            return False  # Still being written
+        if owner != self.owner and time.time() - modified < self.stale_seconds:
+            return False
+
+        # Only one of several processes taking over can rename it away
+        stale_path = f"{claim_path}.{os.urandom(8).hex()}.stale"
+        try:
+            os.rename(claim_path, stale_path)
+        except OSError:
+            return False
+        os.remove(stale_path)
+        logging.info(f"Took over the claim of {owner} on {claim_path}")
+        return True
+
+    def release(self, filepath):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(filepath))
+
+
+def unused_path(path):
+    # path, or path with _1, _2, ... added when it is already taken
+    name, extension = os.path.splitext(path)
+    counter = 0
+    while os.path.lexists(path):
+        counter += 1
+        path = f"{name}_{counter}{extension}"
+    return path
+
+
+def move_to_error_directory(filepath, error_directory, error, interactive=True):
+    # Moves files to IMAGES_ERROR
+    # Use copy to avoid deleting test files
+    filename = os.path.basename(filepath)
+    # Another shard may have moved a file of the same name there already
+    error_file_path = unused_path(os.path.join(error_directory, filename))
+    try:
+        os.rename(filepath, error_file_path)
+    except FileNotFoundError:
+        if os.path.exists(filepath):
+            raise
+        logging.warning(f"{filepath} is gone, it was not moved to {error_directory}")
+    # shutil.copy(filepath, error_file_path)
+
+    logging.error(f"Failed to process {filename}. Error: {error}")
+    if interactive:
+        print(f"An error occurred: {error}")
+        print(f"Check the error output folder: {error_directory}")
+        input("Press Enter to acknowledge and continue...")
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    index = max(
+        0, min(len(sorted_values) - 1, int(fraction * len(sorted_values) + 0.5) - 1)
+    )
+    return sorted_values[index]
+
+
+class StageTimings:
+    # Seconds spent in each stage of a run, per file and in total. Stages that
+    # work on a whole batch, such as metadata extraction, are shared out
+    # evenly over its files. Without keep_files, as in watch mode, only the
+    # counts, totals and maxima are exact and the percentiles come from a
+    # random sample of reservoir_size times per stage, so memory stays flat.
+
+    STAGES = (
+        "scan",
+        "metadata",
+        "fingerprint",
+        "text",
+        "admit",
+        "decode",
+        "orientation",
+        "composite",
+        "encode",
+        "save",
+        "remove_source",
+        "report",
+        "gps",
+    )
+
+    def __init__(self, keep_files=True, reservoir_size=TIMING_RESERVOIR_SIZE):
+        self.samples = {stage: [] for stage in self.STAGES}
+        self.counts = dict.fromkeys(self.STAGES, 0)
+        self.totals = dict.fromkeys(self.STAGES, 0.0)
+        self.maxima = dict.fromkeys(self.STAGES, 0.0)
+        self.keep_files = keep_files
+        self.reservoir_size = reservoir_size
+        self.files = {}  # file path -> {stage: seconds}
+        # Added to from the pipeline's stage threads
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, filepath=None):
+        with self._lock:
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+            self.maxima[stage] = max(self.maxima[stage], seconds)
+            samples = self.samples[stage]
+            if self.keep_files or len(samples) < self.reservoir_size:
+                samples.append(seconds)
+            else:
+                # Every time seen so far is equally likely to be kept
+                index = random.randrange(self.counts[stage])
+                if index < self.reservoir_size:
+                    samples[index] = seconds
+            if filepath is not None and self.keep_files:
+                self.files.setdefault(filepath, {})[stage] = seconds
+
+    @contextlib.contextmanager
+    def measure(self, stage, filepath=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, filepath)
+
+    def summary(self):
+        summary = {}
+        for stage in self.STAGES:
+            with self._lock:
+                samples = sorted(self.samples[stage])
+            summary[stage] = {
+                "count": self.counts[stage],
+                "total": round(self.totals[stage], 6),
+                "p50": round(percentile(samples, 0.50), 6),
+                "p95": round(percentile(samples, 0.95), 6),
+                "max": round(self.maxima[stage], 6),
+            }
+        return summary
+
+
+class ProcessingResult:
+    # Outcome and statistics of a process_directory() run
+
+    def __init__(self, input_directory, output_directory, error_directory):
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.error_directory = error_directory
+        self.status = "completed"  # completed, aborted, missing-input or no-images
+        self.files_seen = 0
+        self.images_found = 0
+        self.processed = 0
+        self.failed = []  # (file path, error message)
+        self.bytes_in = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.resumed = 0
+        self.claimed_elsewhere = 0  # Images another shard was working on
+        self.duplicates = {"exact": 0, "near": 0}
+        self.pixel_budget = None  # PixelBudget when parallel renders are limited
+        self.report_path = None
+        self.spatial_index_path = None
+        self.metadata_seconds = 0.0
+        self.render_seconds = 0.0
+        self.elapsed_seconds = 0.0
+        self.outputs = {}  # output format -> images, bytes written, encode time
+        self.decode_seconds = 0.0
+        self.heic_images = 0
+        self.heic_decode_seconds = 0.0
+        self.heic_render_seconds = 0.0
+        self.timings = StageTimings()
+
+    def add_output(self, render_result):
+        for stage, seconds in render_result.timings.items():
+            self.timings.add(stage, seconds, render_result.source_path)
+        stats = self.outputs.setdefault(
+            render_result.output_format,
+            {"images": 0, "bytes_written": 0, "encode_seconds": 0.0},
+        )
+        stats["images"] += 1
+        stats["bytes_written"] += render_result.bytes_written
+        stats["encode_seconds"] += render_result.encode_seconds
+        self.decode_seconds += render_result.decode_seconds
+        if is_heic_file(render_result.source_path):
+            self.heic_images += 1
+            self.heic_decode_seconds += render_result.decode_seconds
+            self.heic_render_seconds += render_result.render_seconds
+
+    @property
+    def bytes_written(self):
+        return sum(stats["bytes_written"] for stats in self.outputs.values())
+
+    @property
+    def has_errors(self):
+        return bool(self.failed)
+
+    @property
+    def succeeded(self):
+        return self.status == "completed" and not self.failed
+
+    @property
+    def images_per_second(self):
+        if not self.elapsed_seconds:
+            return 0.0
+        return self.processed / self.elapsed_seconds
+
+    def to_dict(self):
+        return {
+            "input_directory": self.input_directory,
+            "output_directory": self.output_directory,
+            "error_directory": self.error_directory,
+            "status": self.status,
+            "files_seen": self.files_seen,
+            "images_found": self.images_found,
+            "processed": self.processed,
+            "failed": [{"file": path, "error": error} for path, error in self.failed],
+            "bytes_in": self.bytes_in,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "resumed": self.resumed,
+            "claimed_elsewhere": self.claimed_elsewhere,
+            "duplicates": dict(self.duplicates),
+            "pixel_budget": (
+                self.pixel_budget.to_dict() if self.pixel_budget is not None else None
+            ),
+            "report_path": self.report_path,
+            "spatial_index_path": self.spatial_index_path,
+            "metadata_seconds": round(self.metadata_seconds, 3),
+            "render_seconds": round(self.render_seconds, 3),
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+            "decode_seconds": round(self.decode_seconds, 3),
+            "bytes_written": self.bytes_written,
+            "outputs": {
+                output_format: dict(
+                    stats, encode_seconds=round(stats["encode_seconds"], 3)
+                )
+                for output_format, stats in self.outputs.items()
+            },
+            "heic": {
+                "images": self.heic_images,
+                "decode_seconds": round(self.heic_decode_seconds, 3),
+                "render_seconds": round(self.heic_render_seconds, 3),
+            },
+            "stages": self.timings.summary(),
+            "images_per_second": round(self.images_per_second, 3),
+        }
+
+
+def write_run_summary(result, path):
+    # Run statistics and the per-file stage times as JSON
+    summary = result.to_dict()
+    summary["files"] = result.timings.files
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+
+
+def format_prometheus(result):
+    # Run statistics in the Prometheus text format, e.g. for the node
+    # exporter's textfile collector
+    lines = [
+        "# HELP metadata_extractor_stage_seconds Seconds per file spent in each stage.",
+        "# TYPE metadata_extractor_stage_seconds summary",
+    ]
+    for stage, stats in result.timings.summary().items():
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("1", "max")):
+            lines.append(
+                f'metadata_extractor_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                f"{stats[key]}"
+            )
+        lines.append(
+            f'metadata_extractor_stage_seconds_sum{{stage="{stage}"}} {stats["total"]}'
+        )
+        lines.append(
+            f'metadata_extractor_stage_seconds_count{{stage="{stage}"}} {stats["count"]}'
+        )
+
+    for name, kind, help_text, value in (
+        ("images_processed_total", "counter", "Images stamped.", result.processed),
+        (
+            "images_failed_total",
+            "counter",
+            "Images moved to the error directory.",
+            len(result.failed),
+        ),
+        (
+            "duplicates_total",
+            "counter",
+            "Images found to duplicate an earlier image.",
+            sum(result.duplicates.values()),
+        ),
+        (
+            "bytes_read_total",
+            "counter",
+            "Bytes of source images read.",
+            result.bytes_in,
+        ),
+        (
+            "bytes_written_total",
+            "counter",
+            "Bytes of stamped images written.",
+            result.bytes_written,
+        ),
+        (
+            "elapsed_seconds",
+            "gauge",
+            "Duration of the run.",
+            round(result.elapsed_seconds, 3),
+        ),
+        (
+            "images_per_second",
+            "gauge",
+            "Throughput of the run.",
+            round(result.images_per_second, 3),
+        ),
+    ):
+        lines.append(f"# HELP metadata_extractor_{name} {help_text}")
+        lines.append(f"# TYPE metadata_extractor_{name} {kind}")
+        lines.append(f"metadata_extractor_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(result, path):
+    # Written under a temporary name so a collector never reads half a file
+    partial_path = path + PARTIAL_SUFFIX
+    with open(partial_path, "w", encoding="utf-8") as f:
+        f.write(format_prometheus(result))
+    os.replace(partial_path, path)
+
+
+def memory_limit_bytes():
+    # The container memory limit (cgroup v2, then v1) or else the physical
+    # memory, None where neither can be read, e.g. on Windows
+    for path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(path, encoding="utf-8") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # "max", or a huge number in v1, when the container has no limit
+        if value.isdigit() and int(value) < 2**60:
+            return int(value)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def image_pixels(filepath, metadata):
+    # Width times height from the extracted metadata, or from the image
+    # header when the metadata has no size. None when neither can be read.
+    width = to_number(metadata.get("Image Width"), int)
+    height = to_number(metadata.get("Image Height"), int)
+    if width and height:
+        return width * height
+    try:
+        with open_image(filepath) as img:
+            return img.size[0] * img.size[1]
+    except Exception:
+        return None
+
+
+class PixelBudget:
+    # Admits renders while the pixels of the images being rendered at once
+    # fit in the budget, so a few panoramas cannot run the host out of
+    # memory. An image larger than the whole budget, or of unknown size,
+    # waits until nothing else is rendering and then runs alone; small
+    # photos keep every worker busy. Images are admitted in the order they
+    # are offered, so a large one is never passed over by smaller ones.
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0  # Renders that had to wait for others to finish
+        self.alone = 0  # Renders too large to share the budget
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_megabytes(cls, megabytes):
+        return cls(int(megabytes * 2**20 / RENDER_BYTES_PER_PIXEL))
+
+    def acquire(self, pixels):
+        # Blocks until the image fits and returns its share, which is handed
+        # back to release() once the render is done
+        share = min(pixels or self.pixels, self.pixels)
+        with self._condition:
+            if share == self.pixels:
+                self.alone += 1
+            if self.in_use and self.in_use + share > self.pixels:
+                self.waits += 1
+                while self.in_use and self.in_use + share > self.pixels:
+                    self._condition.wait()
+            self.in_use += share
+            self.peak = max(self.peak, self.in_use)
+        return share
+
+    def release(self, share):
+        with self._condition:
+            self.in_use -= share
+            self._condition.notify_all()
+
+    def to_dict(self):
+        return {
+            "pixels": self.pixels,
+            "memory_bytes": self.pixels * RENDER_BYTES_PER_PIXEL,
+            "peak_pixels": self.peak,
+            "waits": self.waits,
+            "alone": self.alone,
+        }
+
+
+class BatchRun:
+    # Per-file steps of a run: metadata lookup, rendering, committing the
+    # output and removing the source, each step recorded in the journal
+
+    def __init__(
+        self,
+        result,
+        backend,
+        render_options,
+        journal,
+        cache=None,
+        executor=None,
+        interactive=False,
+        duplicates=None,
+        duplicate_action=DUPLICATE_ACTION,
+        claims=None,
+        budget=None,
+    ):
+        self.result = result
+        self.backend = backend
+        self.render_options = render_options
+        self.journal = journal
+        self.cache = cache
+        self.executor = executor
+        self.interactive = interactive
+        self.duplicates = duplicates  # FingerprintIndex when detection is on
+        self.duplicate_action = duplicate_action
+        self.claims = claims  # FileClaims when other processes share the input
+        self.budget = budget  # PixelBudget when renders run in parallel
+        self.report = None  # Set to stream rows as files finish
+        # The pipeline runs these steps on several threads
+        self._lock = threading.Lock()
+
+    def process(self, entries):
+        # Runs a group of ScannedFile entries through extraction, rendering
+        # and cleanup
+        todo = self.resume_batch(entries)
+        batch_metadata = self.extract(todo)
+
+        pending = []
+        links = []
+        stage_start = time.perf_counter()
+
+        for entry in todo:
+            filepath = entry.path
+            try:
+                logging.info(f"Processing file: {os.path.basename(filepath)}")
+                overlay_text_content, orientation, duplicate = self.prepare(
+                    entry, batch_metadata
+                )
+
+                action = self.action_for(duplicate)
+                if action == "skip":
+                    self.skip_duplicate(filepath, duplicate)
+                elif action == "link":
+                    # Linked once the rest of the batch is saved, so the
+                    # stamped image of a copy in the same batch exists
+                    links.append((entry, overlay_text_content, orientation, duplicate))
+                elif self.executor is not None:
+                    share = self.admit(filepath)
+                    try:
+                        future = self.executor.submit(
+                            render_image,
+                            filepath,
+                            overlay_text_content,
+                            self.render_options,
+                            orientation,
+                        )
+                    except BaseException:
+                        self.release(share)
+                        raise
+                    # Frees the share as soon as the worker is done
+                    future.add_done_callback(lambda _, share=share: self.release(share))
+                    pending.append((filepath, future))
+                else:
+                    self.finish(
+                        filepath,
+                        render_image(
+                            filepath,
+                            overlay_text_content,
+                            self.render_options,
+                            orientation,
+                        ),
+                    )
+
+            except Exception as e:
+                self.fail(filepath, e)
+
+        # Collect worker results in input order
+        for filepath, future in pending:
+            try:
+                self.finish(filepath, future.result())
+            except Exception as e:
+                self.fail(filepath, e)
+        self.finish_links(links)
+
+        self.result.render_seconds += time.perf_counter() - stage_start
+
+    def admit(self, filepath):
+        # Waits until the image fits in the pixel budget, returns its share
+        if self.budget is None:
+            return None
+        file_info = self.journal.entry(filepath).get("file_info") or {}
+        pixels = image_pixels(filepath, file_info.get("metadata") or {})
+        with self.result.timings.measure("admit", filepath):
+            return self.budget.acquire(pixels)
+
+    def release(self, share):
+        if share is not None:
+            self.budget.release(share)
+
+    def resume_batch(self, entries):
+        # Finishes what an earlier run left behind and returns the entries
+        # that still need to be processed
+        todo = []
+        for entry in entries:
+            if self.claims is not None and not self.claims.claim(entry.path):
+                logging.info(f"Skipping {entry.path}, another shard is working on it")
+                with self._lock:
+                    self.result.claimed_elsewhere += 1
+                continue
+            try:
+                if not self.resume(entry.path):
+                    todo.append(entry)
+            except Exception as e:
+                self.fail(entry.path, e)
+
+        if any(entry.extension == ".heic" for entry in todo):
+            # Lets the in-process backend read HEIC image sizes with Pillow
+            register_heif_opener(self.render_options.heic_decode_threads)
+        return todo
+
+    def extract(self, entries):
+        # Extract metadata for a group of files in as few calls as possible
+        image_paths = [entry.path for entry in entries]
+        stage_start = time.perf_counter()
+        batch_metadata = extract_with_cache(
+            self.backend,
+            image_paths,
+            cache=self.cache,
+            result=self.result,
+            file_sizes={entry.path: entry.size for entry in entries},
+        )
+        seconds = time.perf_counter() - stage_start
+        self.result.metadata_seconds += seconds
+        for filepath in image_paths:
+            self.result.timings.add("metadata", seconds / len(image_paths), filepath)
+        return batch_metadata
+
+    def resume(self, filepath):
+        # Finishes a file an earlier run already rendered; returns True when
+        # there is nothing left to do for it
+        entry = self.journal.entry(filepath)
+        state = entry.get("state")
+
+        if state == ProcessingJournal.RENDERED and (
+            os.path.exists(entry["partial_path"])
+            or os.path.exists(entry["output_path"])
+        ):
+            # The rename is atomic, so whichever file exists is complete
+            if os.path.exists(entry["partial_path"]):
+                os.replace(entry["partial_path"], entry["output_path"])
+            self.journal.record(
+                filepath,
+                ProcessingJournal.SAVED,
+                sync=True,
+                output_path=entry["output_path"],
+            )
+            state = ProcessingJournal.SAVED
+
+        if state != ProcessingJournal.SAVED:
+            return False
+
+        os.remove(filepath)
+        self.journal.record(filepath, ProcessingJournal.SOURCE_REMOVED)
+        self.count_processed(filepath, resumed=True)
+        logging.info(f"Finished {filepath} from the journal of the previous run")
+        return True
+
+    def prepare(self, entry, batch_metadata):
+        # Returns the overlay text and EXIF orientation for an image whose
+        # metadata was read, so the renderer does not parse the EXIF again,
+        # and the DuplicateMatch when the image was seen before
+        filepath = entry.path
+        filename = os.path.basename(filepath)
+        if filepath not in batch_metadata:
+            raise ValueError("No metadata could be read")
+        formatted_metadata, raw_metadata = batch_metadata[filepath]
+
+        if WRITE_RAW_METADATA:
+            output_filename = os.path.splitext(filename)[0] + "_metadata.txt"
+            output_path = os.path.join(
+                self.render_options.output_directory, output_filename
+            )
+            write_raw_metadata(raw_metadata, output_path)
+
+        # The size comes from the directory scan, no need to stat again
+        file_size = entry.size
+        file_type = os.path.splitext(filename)[1]
+        self.result.bytes_in += file_size
+
+        file_info = {
+            "filename": filename,
+            "metadata": formatted_metadata,
+            "file_size": file_size,
+            "file_type": file_type,
+            "file_path": filepath,
+        }
+        orientation = ORIENTATION_VALUES.get(formatted_metadata.get("Orientation"), 1)
+        duplicate = self.find_duplicate(filepath, orientation, file_info)
+        self.journal.record(filepath, ProcessingJournal.EXTRACTED, file_info=file_info)
+
+        with self.result.timings.measure("text", filepath):
+            overlay_text_content = build_overlay_text(filepath, formatted_metadata)
+        logging.info(f"Processed file: {filename}")
+        return overlay_text_content, orientation, duplicate
+
+    def find_duplicate(self, filepath, orientation, file_info):
+        # Adds the duplicate group to the report row of the file
+        if self.duplicates is None:
+            return None
+        # Only the journal of this run tells a resumed file from the same
+        # photo sent again under the same name
+        previous = self.journal.entry(filepath)
+        with self.result.timings.measure("fingerprint", filepath):
+            content_hash, perceptual_hash = compute_fingerprint(filepath, orientation)
+            resumed = previous.get("state") in (
+                ProcessingJournal.EXTRACTED,
+                ProcessingJournal.RENDERED,
+            ) and (previous.get("file_info") or {}).get("content_hash") == (
+                content_hash
+            )
+            group, duplicate = self.duplicates.check(
+                filepath, content_hash, perceptual_hash, resumed
+            )
+        file_info["content_hash"] = content_hash
+        file_info["duplicate_group"] = group
+        if duplicate is not None:
+            file_info["duplicate_of"] = duplicate.source_path
+            with self._lock:
+                self.result.duplicates[duplicate.kind] += 1
+            logging.info(
+                f"{os.path.basename(filepath)} is an {duplicate.kind} duplicate of "
+                f"{duplicate.source_path}, action: {self.action_for(duplicate)}"
+            )
+        return duplicate
+
+    def action_for(self, duplicate):
+        # Only exact copies are skipped or linked. A near duplicate is a
+        # different file whose overlay shows its own name, date and position,
+        # so it is reported in its duplicate group and rendered as usual.
+        if duplicate is None:
+            return None
+        if duplicate.kind != "exact":
+            return "render"
+        return self.duplicate_action
+
+    def skip_duplicate(self, filepath, duplicate):
+        # No stamped image of its own, the source goes like a processed file
+        self.journal.record(
+            filepath,
+            ProcessingJournal.SAVED,
+            sync=True,
+            output_path=None,
+            duplicate_of=duplicate.source_path,
+        )
+        self.remove_source(filepath, None)
+
+    def link_duplicate(self, filepath, text, orientation, duplicate):
+        # A hard link to the stamped image of the first copy, or a copy of it
+        # where hard links are not possible. Rendered after all when there is
+        # nothing to link to.
+        original_output = self.duplicates.output_path(duplicate.content_hash)
+        if not original_output or not os.path.exists(original_output):
+            logging.info(
+                f"No stamped image of {duplicate.source_path} to link to, "
+                f"rendering {filepath}"
+            )
+            return render_image(filepath, text, self.render_options, orientation)
+
+        output_path = get_output_path(
+            filepath,
+            text,
+            self.render_options.output_directory,
+            os.path.splitext(original_output)[1],
+        )
+        if os.path.exists(output_path) and os.path.samefile(
+            output_path, original_output
+        ):
+            # Same name and date as the first copy, from another subfolder.
+            # Replacing a link with itself does nothing, which would leave
+            # the partial behind.
+            output_path = unused_path(output_path)
+        partial_path = output_path + PARTIAL_SUFFIX
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial_path)
+        try:
+            os.link(original_output, partial_path)
+        except OSError:
+            shutil.copyfile(original_output, partial_path)
+        # No output format, so it is not counted as a rendered image
+        return RenderResult(filepath, output_path, partial_path)
+
+    def finish_links(self, links):
+        for entry, text, orientation, duplicate in links:
+            try:
+                self.finish(
+                    entry.path,
+                    self.link_duplicate(entry.path, text, orientation, duplicate),
+                )
+            except Exception as e:
+                self.fail(entry.path, e)
+
+    def finish(self, filepath, render_result):
+        self.save(filepath, render_result)
+        self.remove_source(filepath, render_result)
+
+    def save(self, filepath, render_result):
+        self.journal.record(
+            filepath,
+            ProcessingJournal.RENDERED,
+            partial_path=render_result.partial_path,
+            output_path=render_result.output_path,
+        )
+        with self.result.timings.measure("save", filepath):
+            commit_output(render_result)
+            # The output must be on record before the only other copy goes away
+            self.journal.record(
+                filepath,
+                ProcessingJournal.SAVED,
+                sync=True,
+                output_path=render_result.output_path,
+            )
+        if self.duplicates is not None and render_result.output_format is not None:
+            # Later copies of this image link to its stamped image
+            file_info = self.journal.entry(filepath).get("file_info") or {}
+            if file_info.get("content_hash"):
+                self.duplicates.set_output(
+                    file_info["content_hash"], render_result.output_path
+                )
+
+    def remove_source(self, filepath, render_result):
+        with self.result.timings.measure("remove_source", filepath):
+            os.remove(filepath)
+            self.journal.record(filepath, ProcessingJournal.SOURCE_REMOVED)
+        self.count_processed(filepath, render_result)
+
+    def count_processed(self, filepath, render_result=None, resumed=False):
+        # Skipped duplicates and files finished from the journal of an
+        # earlier run have no rendered image
+        with self._lock:
+            self.result.processed += 1
+            if resumed:
+                self.result.resumed += 1
+            elif render_result is not None and render_result.output_format:
+                self.result.add_output(render_result)
+        self.add_report_row(filepath)
+        if self.claims is not None:
+            self.claims.release(filepath)
+
+    def fail(self, filepath, error):
+        move_to_error_directory(
+            filepath, self.result.error_directory, error, self.interactive
+        )
+        with self._lock:
+            self.result.failed.append((filepath, str(error)))
+        self.journal.record(filepath, ProcessingJournal.FAILED, error=str(error))
+        self.add_report_row(filepath)
+        if self.claims is not None:
+            self.claims.release(filepath)
+
+    def add_report_row(self, filepath):
+        file_info = self.journal.entry(filepath).get("file_info")
+        if self.report is not None and file_info:
+            with self.result.timings.measure("report", filepath):
+                self.report.write(file_info)
+                self.report.flush()
+
+
+def open_batch_run(
+    stack,
+    result,
+    journal,
+    overlay_position="top-left",
+    workers=1,
+    metadata_backend=None,
+    use_cache=None,
+    cache_path=None,
+    cache_max_entries=CACHE_MAX_ENTRIES,
+    interactive=False,
+    duplicate_action=DUPLICATE_ACTION,
+    duplicate_distance=DUPLICATE_HASH_DISTANCE,
+    duplicate_index_path=None,
+    shard=None,
+    memory_budget=MEMORY_BUDGET,
+    **render_settings,
+):
+    # Starts everything a run needs; stack closes it all again. Any other
+    # keyword arguments are RenderOptions settings such as output_format.
+    # Shards keep their own cache and fingerprint index, SQLite must not be
+    # shared over a network file system.
+    use_cache = USE_METADATA_CACHE if use_cache is None else use_cache
+
+    # One ExifTool process serves the whole batch
+    exiftool = stack.enter_context(ExifToolSession())
+    backend = create_metadata_backend(
+        metadata_backend or METADATA_BACKEND, session=exiftool
+    )
+
+    cache = None
+    if use_cache:
+        cache_path = cache_path or os.path.join(
+            os.path.dirname(os.path.abspath(result.output_directory)),
+            shard_filename(CACHE_FILENAME, shard),
+        )
+        cache = stack.enter_context(
+            MetadataCache(cache_path, max_entries=cache_max_entries)
+        )
+
+    duplicates = None
+    if duplicate_action:
+        duplicate_index_path = duplicate_index_path or os.path.join(
+            os.path.dirname(os.path.abspath(result.output_directory)),
+            shard_filename(DUPLICATE_INDEX_FILENAME, shard),
+        )
+        duplicates = stack.enter_context(
+            FingerprintIndex(duplicate_index_path, max_distance=duplicate_distance)
+        )
+
+    # Rendering is CPU bound, so it can be spread over several processes
+    executor = None
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = stack.enter_context(
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+        )
+        logging.info(f"Rendering with {workers} worker processes")
+
+    # Parallel renders share a memory budget, so large images are not all
+    # decoded at once
+    budget = None
+    if executor is not None and memory_budget != 0:
+        if memory_budget is None and memory_limit_bytes():
+            memory_budget = memory_limit_bytes() * MEMORY_BUDGET_SHARE / 2**20
+        if memory_budget:
+            budget = result.pixel_budget = PixelBudget.from_megabytes(memory_budget)
+            logging.info(
+                f"Rendering within {memory_budget:.0f} MB, about "
+                f"{budget.pixels / 1e6:.0f} MP at once"
+            )
+
+    if workers > 1 and not render_settings.get("heic_decode_threads"):
+        # Each worker decodes its own HEIC file, so share the cores out
+        render_settings["heic_decode_threads"] = max(
+            1, (os.cpu_count() or 1) // workers
+        )
+    render_options = RenderOptions(
+        result.output_directory, overlay_position, **render_settings
+    )
+
+    claims = None
+    if shard is not None:
+        claims = FileClaims(
+            os.path.join(result.output_directory, CLAIMS_DIRECTORY),
+            result.input_directory,
+            owner=f"{socket.gethostname()} shard {shard[0]}/{shard[1]}",
+        )
+    return BatchRun(
+        result,
+        backend,
+        render_options,
+        journal,
+        cache=cache,
+        executor=executor,
+        interactive=interactive,
+        duplicates=duplicates,
+        duplicate_action=duplicate_action,
+        claims=claims,
+        budget=budget,
+    )
+
+
+class ScannedFile:
+    # An image found by DirectoryScanner, with the size and modification time
+    # taken from the directory listing
+    __slots__ = ("path", "size", "mtime", "extension")
+
+    def __init__(self, path, size, mtime, extension=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.extension = extension or os.path.splitext(path)[1].lower()
+
+    @classmethod
+    def from_path(cls, path):
+        file_stats = os.stat(path)
+        return cls(path, file_stats.st_size, file_stats.st_mtime)
+
+    def __repr__(self):
+        return f"ScannedFile({self.path!r}, size={self.size})"
+
+
+def shard_of(relative_path, count):
+    # Stable across runs, machines and Python versions, unlike hash(). The
+    # path is relative to the input directory, so shards that mount a network
+    # share in different places still agree.
+    digest = hashlib.blake2b(relative_path.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def shard_filename(filename, shard):
+    # processing_journal.jsonl -> processing_journal.shard-2-of-4.jsonl
+    if shard is None:
+        return filename
+    name, extension = os.path.splitext(filename)
+    return f"{name}.shard-{shard[0]}-of-{shard[1]}{extension}"
+
+
+class DirectoryScanner:
+    # Single os.scandir pass over a directory tree that yields a ScannedFile
+    # for each image as it is found. Extensions, our own outputs and the
+    # include/exclude globs are checked on the name before anything is
+    # stat'ed. Patterns match the path relative to the directory, with /
+    # separators, or the file or directory name alone. shard is (index,
+    # count), counting from 1, and keeps only the images of that shard.
+
+    def __init__(
+        self,
+        directory,
+        include=SCAN_INCLUDE,
+        exclude=SCAN_EXCLUDE,
+        max_depth=SCAN_MAX_DEPTH,
+        timings=None,
+        shard=None,
+    ):
+        self.directory = directory
+        self.include = tuple(include or ())
+        self.exclude = tuple(exclude or ())
+        self.max_depth = max_depth
+        self.timings = timings
+        self.shard = shard
+        self.files_seen = 0
+        self.directories_seen = 0
+
+    def __iter__(self):
+        return self.scan()
+
+    def _matches(self, patterns, relative_path, name):
+        return any(
+            fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern)
+            for pattern in patterns
+        )
+
+    def accepts_file(self, relative_path, name):
+        if not is_image_file(name):
+            return False
+        if self.include and not self._matches(self.include, relative_path, name):
+            return False
+        if self._matches(self.exclude, relative_path, name):
+            return False
+        if self.shard is not None:
+            index, count = self.shard
+            return shard_of(relative_path, count) == index - 1
+        return True
+
+    def accepts_directory(self, relative_path, name, depth):
+        # depth is the level of the directory itself, 1 for a subdirectory
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        return not self._matches(self.exclude, relative_path, name)
+
+    def accepts_path(self, path):
+        # The same checks for a single path, e.g. from a file system event
+        relative_path = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        parts = relative_path.split("/")
+        if parts[0] == "..":
+            return False
+        for depth in range(1, len(parts)):
+            if not self.accepts_directory(
+                "/".join(parts[:depth]), parts[depth - 1], depth
+            ):
+                return False
+        return self.accepts_file(relative_path, parts[-1])
+
+    def scan(self):
+        # Directories are listed one at a time, depth first like os.walk, and
+        # each image is handed on before the rest of its directory is read
+        stack = [(self.directory, "", 0)]
+        scan_seconds = 0.0
+        while stack:
+            path, relative_directory, depth = stack.pop()
+            subdirectories = []
+            scan_start = time.perf_counter()
+            try:
+                listing = os.scandir(path)
+            except OSError as e:
+                logging.warning(f"Could not scan {path}: {e}")
+                continue
+
+            with listing:
+                self.directories_seen += 1
+                for entry in listing:
+                    relative_path = relative_directory + entry.name
+                    try:
+                        # Links to directories are not followed, as in os.walk
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.accepts_directory(
+                                relative_path, entry.name, depth + 1
+                            ):
+                                subdirectories.append(
+                                    (entry.path, relative_path + "/", depth + 1)
+                                )
+                            continue
+                        if not entry.is_file():
+                            continue
+                        self.files_seen += 1
+                        if not self.accepts_file(relative_path, entry.name):
+                            continue
+                        # Cached by DirEntry, free on Windows
+                        file_stats = entry.stat()
+                    except OSError as e:
+                        logging.warning(f"Could not read {entry.path}: {e}")
+                        continue
+
+                    scanned = ScannedFile(
+                        entry.path,
+                        file_stats.st_size,
+                        file_stats.st_mtime,
+                        os.path.splitext(entry.name)[1].lower(),
+                    )
+                    scan_seconds += time.perf_counter() - scan_start
+                    if self.timings is not None:
+                        self.timings.add("scan", scan_seconds, entry.path)
+                    scan_seconds = 0.0
+                    yield scanned
+                    scan_start = time.perf_counter()
+
+            scan_seconds += time.perf_counter() - scan_start
+            stack.extend(reversed(subdirectories))
+
+        if self.timings is not None and scan_seconds:
+            # Listing after the last image, e.g. empty directories
+            self.timings.add("scan", scan_seconds)
+
+
+def batched(entries, size=SCAN_BATCH_SIZE):
+    # Groups a stream of entries into lists of at most size entries
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class PipelineRun:
+    # Runs a BatchRun as asyncio stages joined by bounded queues:
+    # scan -> metadata -> render -> write -> cleanup. Each stage does its
+    # blocking work in its own executor, so directory listing, the ExifTool
+    # wait, rendering, saving and removing sources overlap instead of taking
+    # turns. A full queue holds back the stages before it, so slow storage
+    # never lets images pile up in memory.
+
+    def __init__(
+        self,
+        run,
+        renderers=1,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        scan_batches=PIPELINE_SCAN_BATCHES,
+    ):
+        self.run = run
+        # One render at a time in process, one per worker otherwise
+        self.renderers = renderers if run.executor is not None else 1
+        self.queue_size = queue_size
+        self.scan_batches = scan_batches
+
+    def process(self, entries):
+        import asyncio
+
+        # Failures are moved on the cleanup thread, which must not wait on
+        # input(), so they are acknowledged here once the pipeline drains
+        interactive, self.run.interactive = self.run.interactive, False
+        failed_before = len(self.run.result.failed)
+        try:
+            asyncio.run(self._process(entries))
+        finally:
+            self.run.interactive = interactive
+        failed = self.run.result.failed[failed_before:]
+        if interactive and failed:
+            for filepath, error in failed:
+                print(f"An error occurred on {os.path.basename(filepath)}: {error}")
+            print(f"Check the error output folder: {self.run.result.error_directory}")
+            input("Press Enter to acknowledge and continue...")
+
+    async def _process(self, entries):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.loop = asyncio.get_running_loop()
+        self.scanned = asyncio.Queue(self.scan_batches)
+        self.prepared = asyncio.Queue(self.queue_size)
+        self.rendered = asyncio.Queue(self.queue_size)
+        self.saved = asyncio.Queue(self.queue_size)
+        self.renderers_left = self.renderers
+        self.render_start = None
+        self.links = []
+
+        with contextlib.ExitStack() as stack:
+            # The metadata stage owns the ExifTool session and the cache, so
+            # it needs a thread to itself
+            self.executors = {
+                stage: stack.enter_context(
+                    ThreadPoolExecutor(1, thread_name_prefix=f"pipeline-{stage}")
+                )
+                for stage in (
+                    "scan",
+                    "metadata",
+                    "admit",
+                    "render",
+                    "write",
+                    "cleanup",
+                )
+            }
+            if self.run.executor is not None:
+                self.executors["render"] = self.run.executor
+
+            tasks = [
+                asyncio.create_task(self.scan_stage(entries)),
+                asyncio.create_task(self.metadata_stage()),
+                *(
+                    asyncio.create_task(self.render_stage())
+                    for _ in range(self.renderers)
+                ),
+                asyncio.create_task(self.write_stage()),
+                asyncio.create_task(self.cleanup_stage()),
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            finally:
+                if self.render_start is not None:
+                    self.run.result.render_seconds += (
+                        time.perf_counter() - self.render_start
+                    )
+
+    def call(self, stage, function, *args):
+        return self.loop.run_in_executor(self.executors[stage], function, *args)
+
+    async def fail(self, filepath, error):
+        # Failed files are moved on the cleanup thread, never in a worker
+        await self.call("cleanup", self.run.fail, filepath, error)
+
+    async def scan_stage(self, entries):
+        batches = batched(entries)
+        while True:
+            batch = await self.call("scan", next, batches, None)
+            if batch is None:
+                break
+            self.run.result.images_found += len(batch)
+            await self.scanned.put(batch)
+        await self.scanned.put(None)
+
+    async def metadata_stage(self):
+        while True:
+            batch = await self.scanned.get()
+            if batch is None:
+                break
+            todo = await self.call("metadata", self.run.resume_batch, batch)
+            batch_metadata = await self.call("metadata", self.run.extract, todo)
+            for entry in todo:
+                try:
+                    logging.info(f"Processing file: {os.path.basename(entry.path)}")
+                    text, orientation, duplicate = await self.call(
+                        "metadata", self.run.prepare, entry, batch_metadata
+                    )
+                except Exception as e:
+                    await self.fail(entry.path, e)
+                    continue
+
+                action = self.run.action_for(duplicate)
+                if action == "skip":
+                    await self.call(
+                        "cleanup", self.run.skip_duplicate, entry.path, duplicate
+                    )
+                elif action == "link":
+                    # Linked at the end, once every first copy is saved
+                    self.links.append((entry, text, orientation, duplicate))
+                else:
+                    await self.prepared.put((entry, text, orientation))
+
+        for _ in range(self.renderers):
+            await self.prepared.put(None)
+
+    async def render_stage(self):
+        while True:
+            item = await self.prepared.get()
+            if item is None:
+                break
+            entry, text, orientation = item
+            share = None
+            if self.run.budget is not None:
+                # One admission at a time, in queue order
+                share = await self.call("admit", self.run.admit, entry.path)
+            if self.render_start is None:
+                self.render_start = time.perf_counter()
+            try:
+                render_result = await self.call(
+                    "render",
+                    render_image,
+                    entry.path,
+                    text,
+                    self.run.render_options,
+                    orientation,
+                )
+            except Exception as e:
+                await self.fail(entry.path, e)
+                continue
+            finally:
+                self.run.release(share)
+            await self.rendered.put((entry, render_result))
+
+        # The last renderer to finish tells the write stage
+        self.renderers_left -= 1
+        if not self.renderers_left:
+            await self.rendered.put(None)
+
+    async def write_stage(self):
+        while True:
+            item = await self.rendered.get()
+            if item is None:
+                break
+            entry, render_result = item
+            try:
+                await self.call("write", self.run.save, entry.path, render_result)
+            except Exception as e:
+                await self.fail(entry.path, e)
+                continue
+            await self.saved.put(item)
+        await self.saved.put(None)
+
+    async def cleanup_stage(self):
+        while True:
+            item = await self.saved.get()
+            if item is None:
+                break
+            entry, render_result = item
+            try:
+                await self.call(
+                    "cleanup", self.run.remove_source, entry.path, render_result
+                )
+            except Exception as e:
+                await self.fail(entry.path, e)
+        await self.call("cleanup", self.run.finish_links, self.links)
+
+
+def process_directory(
+    input_directory,
+    output_directory,
+    error_directory,
+    overlay_position="top-left",
+    metadata_format=None,
+    workers=1,
+    metadata_backend=None,
+    use_cache=None,
+    cache_path=None,
+    cache_max_entries=CACHE_MAX_ENTRIES,
+    resume=True,
+    clear_directories=False,
+    interactive=False,
+    include=SCAN_INCLUDE,
+    exclude=SCAN_EXCLUDE,
+    max_depth=SCAN_MAX_DEPTH,
+    pipeline=False,
+    pipeline_queue_size=PIPELINE_QUEUE_SIZE,
+    shard=None,
+    **render_settings,
+):
+    # Stamps every image under input_directory and returns a ProcessingResult.
+    # Nothing is asked on the console unless interactive is set. include,
+    # exclude and max_depth limit which files are picked up, see
+    # DirectoryScanner. pipeline runs the stages concurrently, see
+    # PipelineRun. shard is (index, count) to process one part of the input
+    # next to other processes, see merge_shard_reports. Any other keyword
+    # arguments are RenderOptions settings such as font_path.
+    metadata_format = metadata_format or METADATA_FORMAT
+    result = ProcessingResult(input_directory, output_directory, error_directory)
+    start_time = time.perf_counter()
+
+    # Pick up where an interrupted run stopped instead of starting over
+    journal_path = os.path.join(
+        output_directory, shard_filename(JOURNAL_FILENAME, shard)
+    )
+    resuming = False
+    if os.path.exists(journal_path):
+        with ProcessingJournal(journal_path) as previous_journal:
+            resuming = resume and previous_journal.interrupted
+        if not resuming:
+            os.remove(journal_path)
+
+    if resuming:
+        logging.info(f"Resuming the interrupted run recorded in {journal_path}")
+    elif clear_directories and shard is not None:
+        # The other shards are writing to the same directories
+        logging.warning("Sharded runs do not clear the output and error directories")
+    elif clear_directories:
+        # Check and possibly clear the output and error directories
+        for directory in (output_directory, error_directory):
+            if not check_and_clear_directory(directory, assume_yes=not interactive):
+                result.status = "aborted"
+                return result
+
+    if not os.path.exists(input_directory):
+        logging.error(f"Input directory does not exist: {input_directory}")
+        result.status = "missing-input"
+        return result
+
+    # The scan streams images into the pipeline; only the first one is read
+    # up front to check that there is anything to do
+    scanner = DirectoryScanner(
+        input_directory,
+        include,
+        exclude,
+        max_depth,
+        timings=result.timings,
+        shard=shard,
+    )
+    entries = scanner.scan()
+    first_entry = next(entries, None)
+    if first_entry is not None:
+        entries = itertools.chain([first_entry], entries)
+    elif shard is not None:
+        # Still leaves a finished journal behind for merge_shard_reports
+        logging.info(f"No images for shard {shard[0]}/{shard[1]}")
+    elif not resuming:
+        logging.error("No Images found in the input directory.")
+        result.status = "no-images"
+        return result
+
+    # Create directory if not exist
+    os.makedirs(output_directory, exist_ok=True)
+    os.makedirs(error_directory, exist_ok=True)
+
+    with contextlib.ExitStack() as stack:
+        journal = stack.enter_context(ProcessingJournal(journal_path))
+        journal.start()
+        run = open_batch_run(
+            stack,
+            result,
+            journal,
+            overlay_position=overlay_position,
+            **render_settings,
+            workers=workers,
+            metadata_backend=metadata_backend,
+            use_cache=use_cache,
+            cache_path=cache_path,
+            cache_max_entries=cache_max_entries,
+            interactive=interactive,
+            shard=shard,
+        )
+
+        if pipeline:
+            PipelineRun(run, renderers=workers, queue_size=pipeline_queue_size).process(
+                entries
+            )
+        else:
+            for batch in batched(entries):
+                result.images_found += len(batch)
+                run.process(batch)
+        result.files_seen = scanner.files_seen
+
+        # The report is rebuilt from the journal, so files finished by an
+        # earlier, interrupted run are included
+        if CREATE_METADATA_FILE:
+            working_directory_name = os.path.basename(input_directory)
+            result.report_path = os.path.join(
+                output_directory,
+                shard_filename(
+                    working_directory_name + "_MD." + metadata_format, shard
+                ),
+            )
+            report = open_report_writer(result.report_path, metadata_format)
+            file_infos = list(journal.report_rows())
+            with result.timings.measure("gps"):
+                positions = add_report_positions(file_infos)
+            with report:
+                for file_info in file_infos:
+                    with result.timings.measure("report", file_info["file_path"]):
+                        report.write(file_info)
+                # Formats such as xlsx are written out when the report closes
+                with result.timings.measure("report"):
+                    report.close()
+
+            # For shards the index is written by merge_shard_reports
+            if positions is not None and SPATIAL_INDEX and shard is None:
+                result.spatial_index_path = get_spatial_index_path(result.report_path)
+                with result.timings.measure("gps"):
+                    located = write_spatial_index(
+                        result.spatial_index_path, file_infos, *positions
+                    )
+                logging.info(
+                    f"Indexed {located} photo positions in {result.spatial_index_path}"
+                )
+
+        journal.finish()
+
+    if result.has_errors:
+        logging.error(
+            f"Processing completed with errors. Please check: {error_directory}"
+        )
+
+    result.elapsed_seconds = time.perf_counter() - start_time
+    return result
+
+
+def merge_shard_reports(input_directory, output_directory, metadata_format=None):
+    # Combines the shards of a --shard run into the single report, and
+    # spatial index, that an unsharded run writes. The rows are read from the
+    # shard journals, which hold the full metadata whatever format the shard
+    # reports were written in. Returns the report path, None on failure.
+    metadata_format = metadata_format or METADATA_FORMAT
+    name, extension = os.path.splitext(JOURNAL_FILENAME)
+    pattern = re.compile(
+        re.escape(name) + r"\.shard-(\d+)-of-(\d+)" + re.escape(extension) + "$"
+    )
+    journals = {}
+    try:
+        with os.scandir(output_directory) as listing:
+            for entry in listing:
+                match = pattern.match(entry.name)
+                if match:
+                    journals[int(match[1]), int(match[2])] = entry.path
+    except FileNotFoundError:
+        pass
+    if not journals:
+        logging.error(f"No shard journals found in {output_directory}")
+        return None
+
+    counts = {count for _, count in journals}
+    if len(counts) > 1:
+        logging.error(
+            f"Journals of runs with different shard counts {sorted(counts)} "
+            f"in {output_directory}"
+        )
+        return None
+    count = counts.pop()
+    missing = [index for index in range(1, count + 1) if (index, count) not in journals]
+    if missing:
+        logging.warning(
+            f"No journal for shards {missing} of {count}, their images are "
+            "missing from the report"
+        )
+
+    file_infos = []
+    for shard in sorted(journals):
+        with ProcessingJournal(journals[shard]) as journal:
+            if journal.interrupted:
+                logging.warning(
+                    f"Shard {shard[0]}/{count} has not finished, its part of the "
+                    "report is incomplete"
+                )
+            file_infos.extend(journal.report_rows())
+    # The same order whatever the number of shards
+    file_infos.sort(key=lambda file_info: file_info["file_path"])
+
+    report_path = os.path.join(
+        output_directory,
+        os.path.basename(input_directory) + "_MD." + metadata_format,
+    )
+    positions = add_report_positions(file_infos)
+    with open_report_writer(report_path, metadata_format) as report:
+        for file_info in file_infos:
+            report.write(file_info)
+    logging.info(
+        f"Merged {len(file_infos)} images from {len(journals)} shards into "
+        f"{report_path}"
+    )
+
+    if positions is not None and SPATIAL_INDEX:
+        spatial_index_path = get_spatial_index_path(report_path)
+        located = write_spatial_index(spatial_index_path, file_infos, *positions)
+        logging.info(f"Indexed {located} photo positions in {spatial_index_path}")
+    return report_path
+
+
+class FolderWatcher:
+    # Hands out new images under a directory once they have stopped changing,
+    # so files that are still being copied in are left alone. Uses watchdog
+    # (inotify on Linux) when it is installed and polls the tree otherwise.
+
+    def __init__(
+        self,
+        directory,
+        work_queue,
+        stop_event,
+        settle_seconds=WATCH_SETTLE_SECONDS,
+        poll_interval=WATCH_POLL_INTERVAL,
+        scanner=None,
+    ):
+        self.directory = directory
+        self.work_queue = work_queue
+        self.stop_event = stop_event
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        # Decides which files are wanted, for scans and for events alike
+        self.scanner = scanner or DirectoryScanner(directory)
+        self._candidates = {}  # path -> ((size, mtime), unchanged since)
+        self._handed_out = set()
+        self._lock = threading.Lock()
+        self._observer = None
+        self._thread = None
+
+    def start(self):
+        try:
+            from watchdog.observers import Observer
+
+            self._observer = Observer()
+            # Any object with dispatch() can receive watchdog events
+            self._observer.schedule(self, self.directory, recursive=True)
+            self._observer.start()
+            logging.info("Watching for new images with file system events")
+        except ImportError:
+            logging.info("watchdog is not installed, polling for new images")
+        except OSError as e:
+            logging.warning(f"File system events unavailable ({e}), polling instead")
+            self._observer = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        if self._thread is not None:
+            self._thread.join()
+
+    def dispatch(self, event):
+        if not event.is_directory:
+            self.add(getattr(event, "dest_path", "") or event.src_path)
+
+    def add(self, path, checked=False):
+        if not checked and not self.scanner.accepts_path(path):
+            return
+        with self._lock:
+            if path not in self._handed_out:
+                self._candidates.setdefault(path, None)
+
+    def done(self, path):
+        # The file was processed, so a new file with the same name counts again
+        with self._lock:
+            self._handed_out.discard(path)
+
+    def _scan(self):
+        for entry in self.scanner.scan():
+            self.add(entry.path, checked=True)
+
+    def _settled_files(self):
+        now = time.monotonic()
+        with self._lock:
+            candidates = list(self._candidates.items())
+
+        settled = []
+        for path, seen in candidates:
+            try:
+                file_stats = os.stat(path)
+            except OSError:
+                with self._lock:
+                    self._candidates.pop(path, None)
+                continue
+
+            signature = (file_stats.st_size, file_stats.st_mtime)
+            if seen is None or seen[0] != signature:
+                with self._lock:
+                    self._candidates[path] = (signature, now)
+            elif now - seen[1] >= self.settle_seconds:
+                try:
+                    # Still locked by the copying program on Windows
+                    open(path, "rb").close()
+                except OSError:
+                    continue
+                settled.append(ScannedFile(path, *signature))
+        return settled
+
+    def _hand_out(self, entry):
+        with self._lock:
+            self._candidates.pop(entry.path, None)
+            self._handed_out.add(entry.path)
+
+        # Blocks while the queue is full, which holds back the watcher
+        while not self.stop_event.is_set():
+            try:
+                self.work_queue.put(entry, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self):
+        rescan_interval = (
+            self.poll_interval if self._observer is None else WATCH_RESCAN_INTERVAL
+        )
+        last_scan = None
+        while not self.stop_event.is_set():
+            if last_scan is None or time.monotonic() - last_scan >= rescan_interval:
+                self._scan()
+                last_scan = time.monotonic()
+            for entry in self._settled_files():
+                self._hand_out(entry)
+            self.stop_event.wait(0.5)
+
+
+def watch_directory(
+    input_directory,
+    output_directory,
+    error_directory,
+    overlay_position="top-left",
+    metadata_format=None,
+    workers=1,
+    metadata_backend=None,
+    use_cache=None,
+    cache_path=None,
+    cache_max_entries=CACHE_MAX_ENTRIES,
+    settle_seconds=WATCH_SETTLE_SECONDS,
+    poll_interval=WATCH_POLL_INTERVAL,
+    queue_size=WATCH_QUEUE_SIZE,
+    stop_event=None,
+    prometheus_path=None,
+    include=SCAN_INCLUDE,
+    exclude=SCAN_EXCLUDE,
+    max_depth=SCAN_MAX_DEPTH,
+    **render_settings,
+):
+    # Keeps stamping images as they arrive in input_directory until Ctrl+C or
+    # until stop_event is set. Rows go to a daily report that is appended to.
+    # Other keyword arguments are RenderOptions settings, as in process_directory.
+    metadata_format = metadata_format or METADATA_FORMAT
+    if not REPORT_WRITERS[metadata_format].appendable:
+        logging.warning(
+            f"{metadata_format} reports cannot be appended to, using csv in watch mode"
+        )
+        metadata_format = "csv"
+
+    result = ProcessingResult(input_directory, output_directory, error_directory)
+    # Per-file times and every sample would grow without bound in a long run
+    result.timings = StageTimings(keep_files=False)
+    start_time = time.perf_counter()
+    stop_event = stop_event or threading.Event()
+
+    # Create directory if not exist
+    for directory in (input_directory, output_directory, error_directory):
+        os.makedirs(directory, exist_ok=True)
+
+    # Files left over from an interrupted run are finished from the journal
+    journal_path = os.path.join(output_directory, JOURNAL_FILENAME)
+    if os.path.exists(journal_path):
+        with ProcessingJournal(journal_path) as previous_journal:
+            interrupted = previous_journal.interrupted
+        if not interrupted:
+            os.remove(journal_path)
+
+    work_queue = queue.Queue(maxsize=queue_size)
+    watcher = FolderWatcher(
+        input_directory,
+        work_queue,
+        stop_event,
+        settle_seconds,
+        poll_interval,
+        scanner=DirectoryScanner(input_directory, include, exclude, max_depth),
+    )
+
+    with contextlib.ExitStack() as stack:
+        journal = stack.enter_context(ProcessingJournal(journal_path))
+        journal.start()
+        run = open_batch_run(
+            stack,
+            result,
+            journal,
+            overlay_position=overlay_position,
+            **render_settings,
+            workers=workers,
+            metadata_backend=metadata_backend,
+            use_cache=use_cache,
+            cache_path=cache_path,
+            cache_max_entries=cache_max_entries,
+        )
+        report_date = None
+
+        watcher.start()
+        logging.info(f"Watching {input_directory} for new images (Ctrl+C to stop)")
+        try:
+            while not stop_event.is_set():
+                try:
+                    batch = [work_queue.get(timeout=0.5)]
+                except queue.Empty:
+                    continue
+
+                # Take whatever else is waiting, up to one ExifTool chunk
+                while len(batch) < EXIFTOOL_CHUNK_SIZE:
+                    try:
+                        batch.append(work_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                # Start a new report and journal each day
+                today = datetime.now().strftime("%Y-%m-%d")
+                if today != report_date:
+                    if run.report is not None:
+                        run.report.close()
+                        journal.reset()
+                    if CREATE_METADATA_FILE:
+                        working_directory_name = os.path.basename(input_directory)
+                        result.report_path = os.path.join(
+                            output_directory,
+                            f"{working_directory_name}_MD_{today}.{metadata_format}",
+                        )
+                        run.report = open_report_writer(
+                            result.report_path, metadata_format, append=True
+                        )
+                    report_date = today
+
+                result.files_seen += len(batch)
+                result.images_found += len(batch)
+                run.process(batch)
+                for entry in batch:
+                    watcher.done(entry.path)
+
+                if prometheus_path:
+                    # Keep the dashboards current while the watch runs
+                    result.elapsed_seconds = time.perf_counter() - start_time
+                    write_prometheus(result, prometheus_path)
+
+        except KeyboardInterrupt:
+            logging.info("Stopping watch mode")
+        finally:
+            watcher.stop()
+            if run.report is not None:
+                run.report.close()
+
+        journal.finish()
+
+    result.elapsed_seconds = time.perf_counter() - start_time
+    return result
+
+
+def parse_overlay_position(value):
+    # Accepts the menu number (1-4) or the position name
+    if value.isdigit() and int(value) in OVERLAY_POSITIONS:
+        return OVERLAY_POSITIONS[int(value)]
+    if value in OVERLAY_POSITIONS.values():
+        return value
+    raise argparse.ArgumentTypeError(
+        f"invalid overlay position: {value} (use 1-4 or "
+        + ", ".join(OVERLAY_POSITIONS.values())
+        + ")"
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=f"MySmartPlans MetaData Tracker v{__version__}"
+    )
+    parser.add_argument(
+        "--version", action="version", version=f"%(prog)s {__version__}"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="report the installed dependencies, ExifTool, font and directories "
+        "and exit",
+    )
+    parser.add_argument(
+        "--input-dir", help="directory with the images (default: IMAGES_IN)"
+    )
+    parser.add_argument(
+        "--output-dir", help="directory for stamped images (default: IMAGES_OUT)"
+    )
+    parser.add_argument(
+        "--error-dir", help="directory for failed images (default: IMAGES_ERROR)"
+    )
+    parser.add_argument(
+        "--position",
+        type=parse_overlay_position,
+        help="overlay position, 1-4 or top-left, top-right, bottom-left, bottom-right",
+    )
+    parser.add_argument(
+        "--font",
+        help=f"TrueType font for the overlay (default: {FONT_PATH}, "
+        "falls back to a font bundled with Pillow)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=("png", "jpeg", "webp", "source"),
+        default=OUTPUT_FORMAT,
+        help="format of the stamped images, source keeps the format of each "
+        f"input file (default: {OUTPUT_FORMAT})",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=OUTPUT_QUALITY,
+        help=f"JPEG, WebP and HEIC quality, 1-100 (default: {OUTPUT_QUALITY})",
+    )
+    parser.add_argument(
+        "--png-compress-level",
+        type=int,
+        choices=range(10),
+        default=PNG_COMPRESS_LEVEL,
+        metavar="0-9",
+        help="PNG compression, 0 is fastest and 9 smallest "
+        f"(default: {PNG_COMPRESS_LEVEL})",
+    )
+    parser.add_argument(
+        "--max-dimension",
+        type=int,
+        default=MAX_DIMENSION,
+        metavar="PIXELS",
+        help="scale stamped images down so their longest side is at most PIXELS, "
+        "decoding JPEG and HEIC files at reduced size (default: full size)",
+    )
+    parser.add_argument(
+        "--heic-threads",
+        type=int,
+        metavar="N",
+        help="threads used to decode each HEIC image (default: "
+        f"{HEIC_DECODE_THREADS}, or the cores divided by --workers)",
+    )
+    parser.add_argument(
+        "--keep-exif",
+        action="store_true",
+        default=KEEP_EXIF,
+        help="copy the EXIF data of each source image into the stamped image",
+    )
+    parser.add_argument(
+        "--no-icc-profile",
+        action="store_false",
+        dest="keep_icc_profile",
+        default=KEEP_ICC_PROFILE,
+        help="do not copy the color profile of the source image",
+    )
+    parser.add_argument(
+        "--metadata-format",
+        choices=tuple(REPORT_WRITERS),
+        default=METADATA_FORMAT,
+        help=f"format of the metadata report (default: {METADATA_FORMAT})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to render images (default: 1)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always extract metadata instead of using the metadata cache",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=CACHE_MAX_ENTRIES,
+        help=f"maximum number of cached files (default: {CACHE_MAX_ENTRIES})",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="start over even if the previous run was interrupted",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=list(SCAN_INCLUDE),
+        metavar="GLOB",
+        help="only process files matching this pattern, e.g. '*.heic' or "
+        "'2024/*' (can be repeated)",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=list(SCAN_EXCLUDE),
+        metavar="GLOB",
+        help="skip files and directories matching this pattern (can be repeated)",
+    )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=SCAN_MAX_DEPTH,
+        metavar="N",
+        help="only descend N directory levels below the input directory, "
+        "0 for the input directory alone (default: no limit)",
+    )
+    parser.add_argument(
+        "--duplicates",
+        choices=("skip", "link", "render"),
+        default=DUPLICATE_ACTION,
+        help="look for images that were seen before and skip them, link their "
+        "stamped image to the earlier one or render them anyway; near "
+        "duplicates are always rendered, and every choice records the "
+        "duplicate group in the report (default: no detection)",
+    )
+    parser.add_argument(
+        "--duplicate-distance",
+        type=int,
+        default=DUPLICATE_HASH_DISTANCE,
+        metavar="BITS",
+        help="how many of the 64 perceptual hash bits may differ for a near "
+        f"duplicate, 0 for exact copies only (default: {DUPLICATE_HASH_DISTANCE})",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="overlap metadata extraction, rendering, saving and removing the "
+        "sources instead of doing one after the other",
+    )
+    parser.add_argument(
+        "--pipeline-queue-size",
+        type=int,
+        default=PIPELINE_QUEUE_SIZE,
+        metavar="N",
+        help="images waiting between the stages of --pipeline "
+        f"(default: {PIPELINE_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=MEMORY_BUDGET,
+        metavar="MB",
+        help="memory the parallel renders of --workers may use together; large "
+        "images wait for room and images too large for the budget are rendered "
+        "alone, 0 for no limit (default: half of the container or system memory)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help="process only part I of N of the input, e.g. 2/4, so N processes "
+        "or machines can share the directories; combine the reports with "
+        "--merge-shards afterwards",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="combine the reports of a --shard run into one report and exit",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and stamp images as they arrive in the input directory",
+    )
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=WATCH_SETTLE_SECONDS,
+        help="how long a new file must stay unchanged before it is processed "
+        f"in watch mode (default: {WATCH_SETTLE_SECONDS})",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=WATCH_POLL_INTERVAL,
+        help="seconds between scans in watch mode when inotify is unavailable "
+        f"(default: {WATCH_POLL_INTERVAL})",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=WATCH_QUEUE_SIZE,
+        help=f"images waiting to be processed in watch mode (default: {WATCH_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="PATH",
+        help="write run statistics, stage times and per-file times as JSON",
+    )
+    parser.add_argument(
+        "--prometheus-file",
+        metavar="PATH",
+        help="write run statistics in the Prometheus text format, updated after "
+        "every batch in watch mode",
+    )
+    parser.add_argument(
+        "--near",
+        type=parse_position,
+        metavar="LAT,LON",
+        help="list the photos taken within --radius of this position, using the "
+        "spatial index written next to each report, and exit",
+    )
+    parser.add_argument(
+        "--radius",
+        type=float,
+        default=100.0,
+        metavar="METRES",
+        help="search radius for --near (default: 100)",
+    )
+    parser.add_argument(
+        "--spatial-index",
+        nargs="+",
+        metavar="PATH",
+        help=f"spatial indexes to search with --near (default: every "
+        f"*{SPATIAL_INDEX_SUFFIX} in the output directory)",
+    )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help="run without prompts, answering yes to every question",
+    )
+    args = parser.parse_args(argv)
+    if args.shard and args.watch:
+        parser.error("--shard cannot be used with --watch")
+    return args
+
+
+def parse_position(value):
+    try:
+        latitude, longitude = (float(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid position: {value} (use LAT,LON in decimal degrees)"
+        )
+    if abs(latitude) > 90 or abs(longitude) > 180:
+        raise argparse.ArgumentTypeError(f"position out of range: {value}")
+    return latitude, longitude
+
+
+# Modules reported by --check: module, what it is used for, always required
+CHECK_MODULES = (
+    ("PIL", "Pillow, reading and stamping images", True),
+    ("exifread", "ExifRead, in-process metadata", True),
+    ("openpyxl", "openpyxl, xlsx reports", False),
+    ("pyarrow", "pyarrow, parquet reports", False),
+    ("pillow_heif", "pillow-heif, HEIC images", False),
+    ("numpy", "numpy, spatial index and --near", False),
+    ("watchdog", "watchdog, file system events in --watch", False),
+)
+
+
+def check_installation(directories, metadata_format=None, font_path=None):
+    # --check: what this installation can do, found without importing the
+    # modules themselves. Only the font check loads Pillow's ImageFont, to
+    # see which font actually opens. Returns 1 when something needed is
+    # missing.
+    import importlib.util
+
+    metadata_format = metadata_format or METADATA_FORMAT
+    frozen = " (frozen)" if getattr(sys, "frozen", False) else ""
+    print(f"MetaData Extractor {__version__}, Python {sys.version.split()[0]}{frozen}")
+    problems = 0
+
+    for module, purpose, required in CHECK_MODULES:
+        required = required or (module, metadata_format) in (
+            ("openpyxl", "xlsx"),
+            ("pyarrow", "parquet"),
+        )
+        found = importlib.util.find_spec(module) is not None
+        problems += required and not found
+        status = "ok" if found else "MISSING" if required else "missing"
+        print(f"{status:<8} {module:<12} {purpose}")
+
+    found = exiftool_available()
+    required = METADATA_BACKEND == "exiftool"
+    problems += required and not found
+    status = "ok" if found else "MISSING" if required else "missing"
+    print(f"{status:<8} {'exiftool':<12} {get_exiftool_path()}")
+
+    if importlib.util.find_spec("PIL") is not None:
+        path = resolve_font_path(font_path or FONT_PATH)
+        print(f"{'ok':<8} {'font':<12} {path or 'bundled with Pillow'}")
+
+    for name, directory in directories:
+        if os.path.isdir(directory):
+            writable = os.access(directory, os.W_OK)
+            problems += not writable
+            status = "ok" if writable else "READONLY"
+        else:
+            status = "missing"  # Created when a run starts
+        print(f"{status:<8} {name:<12} {directory}")
+
+    return 1 if problems else 0
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value} (use I/N, e.g. 1/4)")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard out of range: {value}")
+    return index, count
+
+
+def query_near(position, radius_metres, index_paths):
+    # Prints the photos within radius_metres of position as CSV, nearest first
+    writer = csv.writer(sys.stdout)
+    writer.writerow(
+        ("distance_m", "latitude", "longitude", "file_path", "index", "row")
+    )
+    # Each index is sorted on its own, so the matches of all of them are
+    # sorted together before anything is written
+    matches = []
+    for index_path in index_paths:
+        index = SpatialIndex(index_path)
+        for distance, row, file_path, latitude, longitude in index.within(
+            *position, radius_metres
+        ):
+            matches.append((distance, latitude, longitude, file_path, index_path, row))
+    matches.sort(key=lambda match: match[0])
+    for distance, *rest in matches:
+        writer.writerow((round(distance, 1), *rest))
+    return 0 if matches else 1
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    interactive = not args.yes
+
+    if args.near:
+        # Answered from the spatial indexes alone, nothing is processed
+        index_paths = args.spatial_index or sorted(
+            glob.glob(
+                os.path.join(
+                    args.output_dir or os.path.join(get_base_path(), "IMAGES_OUT"),
+                    "*" + SPATIAL_INDEX_SUFFIX,
+                )
+            )
+        )
+        if not index_paths:
+            print("No spatial index found, run a batch first", file=sys.stderr)
+            return 1
+        return query_near(args.near, args.radius, index_paths)
+
+    if args.check:
+        base_path = get_base_path()
+        return check_installation(
+            (
+                ("input", args.input_dir or os.path.join(base_path, "IMAGES_IN")),
+                ("output", args.output_dir or os.path.join(base_path, "IMAGES_OUT")),
+                ("error", args.error_dir or os.path.join(base_path, "IMAGES_ERROR")),
+            ),
+            args.metadata_format,
+            args.font,
+        )
+
+    setup_logging(assume_yes=args.yes)
+
+    base_path = get_base_path()
+
+    # input_directory = r"E:\Python\xPDFTestFiles\IMAGES_IN"
+    # output_directory = r"E:\Python\xPDFTestFiles\IMAGES_OUT"
+    # error_directory = r"E:\Python\xPDFTestFiles\IMAGES_ERROR"
+
+    input_directory = args.input_dir or os.path.join(base_path, "IMAGES_IN")
+    output_directory = args.output_dir or os.path.join(base_path, "IMAGES_OUT")
+    error_directory = args.error_dir or os.path.join(base_path, "IMAGES_ERROR")
+
+    if args.merge_shards:
+        report_path = merge_shard_reports(
+            input_directory, output_directory, args.metadata_format
+        )
+        return 0 if report_path else 1
+
+    overlay_position = args.position
+    if overlay_position is None and interactive:
+        # User selects the overlay position
+        print("Choose the orientation of the metadata overlay for this batch of files:")
+        print("1: Top Left (Default)")
+        print("2: Top Right")
+        print("3: Bottom Left")
+        print("4: Bottom Right")
+        overlay_choice = input(
+            "Enter your choice (1-4, or press Enter for default): "
+        ).strip()
+        if not overlay_choice:
+            overlay_choice = "1"
+        overlay_position = OVERLAY_POSITIONS.get(int(overlay_choice), "top-left")
+    overlay_position = overlay_position or "top-left"
+
+    logging.info(f"Starting Metadata Extractor version {__version__}")
+    logging.info(f"Using overlay position {overlay_position}")
+    if interactive:
+        time.sleep(1)
+
+    options = {
+        "overlay_position": overlay_position,
+        "font_path": args.font,
+        "output_format": args.output_format,
+        "output_quality": args.quality,
+        "png_compress_level": args.png_compress_level,
+        "keep_exif": args.keep_exif,
+        "keep_icc_profile": args.keep_icc_profile,
+        "max_dimension": args.max_dimension,
+        "heic_decode_threads": args.heic_threads,
+        "metadata_format": args.metadata_format,
+        "workers": max(1, args.workers),
+        "use_cache": not args.no_cache,
+        "cache_max_entries": args.cache_size,
+        "include": args.include,
+        "exclude": args.exclude,
+        "max_depth": args.max_depth,
+        "duplicate_action": args.duplicates,
+        "duplicate_distance": max(0, args.duplicate_distance),
+        "memory_budget": args.memory_budget,
+    }
+    if args.watch:
+        result = watch_directory(
+            input_directory,
+            output_directory,
+            error_directory,
+            settle_seconds=args.settle_seconds,
+            poll_interval=args.poll_interval,
+            queue_size=args.queue_size,
+            prometheus_path=args.prometheus_file,
+            **options,
+        )
+    else:
+        result = process_directory(
+            input_directory,
+            output_directory,
+            error_directory,
+            resume=not args.no_resume,
+            clear_directories=True,
+            interactive=interactive,
+            pipeline=args.pipeline,
+            pipeline_queue_size=max(1, args.pipeline_queue_size),
+            shard=args.shard,
+            **options,
+        )
+
+    if result.status == "completed":
+        logging.info(
+            f"Processed {result.processed} of {result.images_found} images "
+            f"in {result.elapsed_seconds:.1f}s ({result.images_per_second:.2f} images/s)"
+        )
+        if result.cache_hits:
+            logging.info(f"Metadata cache hits: {result.cache_hits}")
+        if result.pixel_budget is not None and result.pixel_budget.waits:
+            logging.info(
+                f"{result.pixel_budget.waits} renders waited for memory, "
+                f"{result.pixel_budget.alone} large images were rendered alone"
+            )
+        if result.claimed_elsewhere:
+            logging.info(
+                f"Left {result.claimed_elsewhere} images to the other shards "
+                "working on them"
+            )
+        if any(result.duplicates.values()):
+            logging.info(
+                f"Duplicates: {result.duplicates['exact']} exact, "
+                f"{result.duplicates['near']} near ({args.duplicates})"
+            )
+        if result.heic_images:
+            logging.info(
+                f"Decoded {result.heic_images} HEIC images in "
+                f"{result.heic_decode_seconds:.1f}s "
+                f"({result.heic_render_seconds / result.heic_images:.2f}s per image)"
+            )
+        for output_format, stats in result.outputs.items():
+            logging.info(
+                f"Wrote {stats['images']} {output_format} images, "
+                f"{stats['bytes_written'] / 2**20:.1f} MB "
+                f"in {stats['encode_seconds']:.1f}s of encoding"
+            )
+        for stage, stats in result.timings.summary().items():
+            if stats["count"]:
+                logging.info(
+                    f"Stage {stage}: {stats['count']} times, "
+                    f"p50 {stats['p50'] * 1000:.1f} ms, "
+                    f"p95 {stats['p95'] * 1000:.1f} ms, "
+                    f"max {stats['max'] * 1000:.1f} ms"
+                )
+
+    if args.stats_json:
+        write_run_summary(result, args.stats_json)
+    if args.prometheus_file:
+        write_prometheus(result, args.prometheus_file)
+
+    # Testing only
+    if interactive:
+        input("Press Enter to close this window...")
+
+    return 0 if result.succeeded else 1
+
+
+if __name__ == "__main__":
+    import multiprocessing
+
+    # Needed for worker processes in the frozen Windows build
+    multiprocessing.freeze_support()
+    sys.exit(main())